@@ -1,13 +1,26 @@
 import re
 import sys
+import json
+import socket
+import zlib
+import operator
+import hashlib
 import threading
 import collections
-from httplib2 import Http
 try:
-    from urllib.parse import urlsplit, urljoin
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+from httplib2 import Http, HTTPConnectionWithTimeout, HTTPSConnectionWithTimeout
+try:
+    from urllib.parse import urlsplit, urljoin, quote
+    from http.client import HTTPResponse
 except ImportError:
     # Python 2
     from urlparse import urlsplit, urljoin
+    from urllib import quote
+    from httplib import HTTPResponse
 
 import webob
 
@@ -28,6 +41,12 @@ try:
 except NameError:
     basestring = str
 
+try:
+    from time import perf_counter as _now
+except ImportError:
+    # Python 2
+    from time import time as _now
+
 #
 # Policies that can make the middleware work like different ESI processors
 #
@@ -36,12 +55,83 @@ class Policy(object):
     max_nested_includes = None
     chase_redirect = False
     cache = None
+    #: Replace the ETag of assembled pages by one computed from the validators
+    #: of the page and all it's includes and answer If-None-Match with 304
+    composite_etag = False
+    #: Maximum number of concurrent include requests to a host, either a
+    #: number for every host or a dict of ``{host[:port]: number}``
+    max_connections_per_host = None
+    #: Seconds to wait for a connection to a host with no free connections
+    #: before the include fails. ``None`` waits forever.
+    connection_wait_timeout = None
+    #: Connect to some hosts at another address, e.g. a local one, without
+    #: changing the include URLs or Host header. A dict of
+    #: ``{host[:port]: address}`` where address is ``'unix:/path/to/socket'``,
+    #: ``'host:port'`` or ``'[ipv6 address]:port'``. Only applies to http URLs.
+    host_map = None
+    #: Maximum size in bytes of an include. Larger includes fail as soon as
+    #: that is known while reading them and the connection is closed.
+    max_fragment_size = None
+    #: Maximum number of ``<esi:inline fetchable="yes">`` fragments kept in
+    #: memory to serve includes of their name for ``inline_fragment_ttl``
+    #: seconds. Only fragments in the page or in includes from the same host as
+    #: their name are kept. 0 disables.
+    inline_fragments = 0
+    inline_fragment_ttl = 60
+    #: Learn which includes the pages at each URL contain and start fetching
+    #: up to this many of them in parallel with the wrapped app. 0 disables.
+    prefetch = 0
+    #: Maximum number of threads prefetching includes, for all requests.
+    #: Nothing is prefetched while they are all busy.
+    prefetch_threads = 10
+    #: Hosts (``host[:port]``) which are known to be slow or unreliable. When
+    #: an ``<esi:attempt>`` includes from them, the includes of the
+    #: ``<esi:except>`` are fetched at the same time.
+    speculative_except_hosts = ()
+    #: The cookies includes can depend on. If set, only these cookies are sent
+    #: to includes which answered with ``Vary: Cookie`` so that a cached
+    #: response can be used for all users with the same values.
+    vary_cookies = None
+    #: The languages includes are available in. For includes which answered
+    #: with ``Vary: Accept-Language``, ``Accept-Language`` is reduced to the
+    #: preferred one of them. ``True`` only removes quality values and
+    #: normalizes case and whitespace.
+    vary_languages = None
+    #: Trace all requests, recording the includes of each page with timings,
+    #: cache status and size. In debug mode, requests with the
+    #: ``trace_header`` header are also traced.
+    trace = False
+    trace_header = 'X-ESI-Trace'
+    #: Where traces are sent: ``'header'`` adds them in the ``trace_header``
+    #: response header, ``'comment'`` in an HTML comment at the end of the
+    #: page. A callable is called with the trace and the request.
+    trace_output = 'header'
 
     def http(self):
-        http = Http(cache=self.cache, timeout=5, disable_ssl_certificate_validation=True)
+        max_size = self.max_fragment_size
+        if self.host_map or max_size is not None:
+            http = _HostMappedHttp(cache=self.cache, timeout=5, disable_ssl_certificate_validation=True)
+            http.connection_types = dict((_normalize_host(host), _mapped_connection(address, max_size))
+                                         for host, address in (self.host_map or {}).items())
+            if max_size is not None:
+                http.uncompressed = True
+                if hasattr(http, 'limit_kwargs'):
+                    # newer httplib2 can also limit decompressing responses
+                    # sent compressed anyway
+                    http.limit_kwargs['hard_limit'] = max_size
+                http.scheme_connection_types = {
+                        'http': _limited_connection(HTTPConnectionWithTimeout, max_size),
+                        'https': _limited_connection(HTTPSConnectionWithTimeout, max_size)}
+        else:
+            http = Http(cache=self.cache, timeout=5, disable_ssl_certificate_validation=True)
         http.follow_redirects = self.chase_redirect
         return http
 
+    def limiter(self):
+        if self.max_connections_per_host is None:
+            return None
+        return _HostLimiter(self.max_connections_per_host, self.connection_wait_timeout)
+
 class AkamaiPolicy(Policy):
     """Configure the middleware to behave like akamai"""
     max_nested_includes = 5
@@ -66,19 +156,120 @@ class _Counter(dict):
     def __missing__(self, key):
         return 0
 
+class _CountMinSketch(object):
+    """Approximate access frequencies of keys in a small, fixed space.
+
+    Counters saturate at 15 and are all halved once ``sample_size``
+    increments have been made so that old popularity fades away.
+    """
+
+    def __init__(self, width, sample_size=None, depth=4):
+        self.width = width
+        if sample_size is None:
+            sample_size = width * 2
+        self.sample_size = sample_size
+        self.additions = 0
+        self._rows = [[0] * width for i in range(depth)]
+
+    def _indexes(self, key):
+        width = self.width
+        return [(row, hash((i, key)) % width) for i, row in enumerate(self._rows)]
+
+    def increment(self, key):
+        for row, i in self._indexes(key):
+            if row[i] < 15:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.age()
+
+    def estimate(self, key):
+        return min([row[i] for row, i in self._indexes(key)])
+
+    def age(self):
+        for row in self._rows:
+            for i, count in enumerate(row):
+                row[i] = count >> 1
+        self.additions >>= 1
+
+class _Memo(dict):
+    """A dict which is emptied when it grows larger than ``maxsize``"""
+
+    def __init__(self, maxsize):
+        dict.__init__(self)
+        self.maxsize = maxsize
+
+    def __setitem__(self, key, value):
+        if len(self) >= self.maxsize:
+            self.clear()
+        dict.__setitem__(self, key, value)
+
+class _InlineFragment(bytes):
+    """The content of an esi:inline, with the time it ``expires``"""
+
+class _Compressed(bytes):
+    """A zlib compressed cache entry"""
+
+#: Find the Surrogate-Key header in the headers httplib2 stores with a response
+_re_surrogate_key = re.compile(br'^surrogate-key:[ \t]*(.*?)\r?$', flags=re.I | re.M)
+
+def _surrogate_keys(value):
+    """Return the tags in the Surrogate-Key header of a cached httplib2 response"""
+    if not isinstance(value, bytes):
+        return ()
+    end = value.find(b'\r\n\r\n')
+    if end == -1:
+        return ()
+    match = _re_surrogate_key.search(value, 0, end)
+    if match is None:
+        return ()
+    return tuple(set(match.group(1).decode('latin-1').split()))
+
 class LRUCache(object):
 
-    def __init__(self, maxsize=1000, max_object_size=102400):
+    def __init__(self, maxsize=1000, max_object_size=102400,
+                 compress_threshold=None, compress_level=6, tinylfu=False):
         # 1000 * 40kb/page ~ 40Mb
         maxqueue = maxsize * 10
         queuedrop = maxsize * 2
         # set instance variables so we can test
         self._cache = cache = {}
+        # Surrogate-Key tag -> {key: True} and key -> tags
+        self._tags = tags = {}
+        self._key_tags = key_tags = {}
         self._refcount = refcount = _Counter()
         self._queue = queue = collections.deque()
         lock = threading.Lock()
         self.hits = 0
         self.misses = 0
+        # new objects not stored because they were less popular than the
+        # object they would have replaced (when tinylfu is used)
+        self.rejected = 0
+        self._sketch = sketch = None
+        if tinylfu:
+            self._sketch = sketch = _CountMinSketch(max(64, maxsize * 4),
+                                                    sample_size=maxsize * 10)
+        # compression statistics
+        self.compressed = 0
+        self.bytes_saved = 0
+        self.compress_time = 0.0
+        self.decompress_time = 0.0
+
+        def compress(value):
+            # compress byte values larger than compress_threshold, but only
+            # keep the result if it is actually smaller
+            if compress_threshold is None \
+                    or not isinstance(value, bytes) \
+                    or len(value) < compress_threshold:
+                return value
+            start = _now()
+            compressed = zlib.compress(value, compress_level)
+            self.compress_time += _now() - start
+            if len(compressed) >= len(value):
+                return value
+            self.compressed += 1
+            self.bytes_saved += len(value) - len(compressed)
+            return _Compressed(compressed)
 
         def compact_queue():
             # compact the queue when it gets too big
@@ -108,6 +299,9 @@ class LRUCache(object):
                     queue.append(k)
 
         def get(key):
+            if sketch is not None:
+                # not locked, lost increments only make the counts less exact
+                sketch.increment(key)
             if lock.acquire(False):
                 try:
                     queue.append(key)
@@ -119,41 +313,99 @@ class LRUCache(object):
             val = cache.get(key, _marker)
             if val is not _marker:
                 self.hits += 1
+                if isinstance(val, _Compressed):
+                    start = _now()
+                    val = zlib.decompress(val)
+                    self.decompress_time += _now() - start
                 return val
             self.misses += 1
             return None
 
-        def set(key, value):
+        def pop_lru():
+            # remove the last reference to a key from the queue
+            key = queue.popleft()
+            refcount[key] -= 1
+            while refcount[key]:
+                key = queue.popleft()
+                refcount[key] -= 1
+            del refcount[key]
+            return key
+
+        def set(key, value, value_tags=()):
             if max_object_size is not None and getsizeof(value) > max_object_size:
                 # note, this doesn't take into account the size of objects referenced by value
                 return
             orig_key = key
-            if len(cache) >= maxsize:
-                # remove least recently used
-                key = queue.popleft()
-                refcount[key] -= 1
-                while refcount[key]:
-                    key = queue.popleft()
-                    refcount[key] -= 1
-                del refcount[key]
+            if sketch is not None and len(cache) >= maxsize and orig_key not in cache:
+                # TinyLFU admission: only replace the least recently used
+                # object if the new one is accessed more frequently. This
+                # stops a scan of one-off keys flushing the popular ones.
+                key = pop_lru()
+                while key not in cache and queue:
+                    key = pop_lru()
+                if key in cache and sketch.estimate(orig_key) <= sketch.estimate(key):
+                    # keep the victim where it was
+                    queue.appendleft(key)
+                    refcount[key] += 1
+                    self.rejected += 1
+                    return
                 delete(key)
+            elif len(cache) >= maxsize:
+                # remove least recently used
+                delete(pop_lru())
             queue.appendleft(orig_key)
             refcount[orig_key] += 1
             cache[orig_key] = value
+            untag(orig_key)
+            if value_tags:
+                key_tags[orig_key] = value_tags
+                for tag in value_tags:
+                    tags.setdefault(tag, {})[orig_key] = True
 
         def locked_set(key, value):
+            # parse and compress outside the lock, it's the expensive part
+            value_tags = _surrogate_keys(value)
+            value = compress(value)
             lock.acquire()
             try:
-                set(key, value)
+                set(key, value, value_tags)
             finally:
                 lock.release()
 
+        def untag(key):
+            for tag in key_tags.pop(key, ()):
+                keys = tags.get(tag)
+                if keys is not None:
+                    keys.pop(key, None)
+                    if not keys:
+                        del tags[tag]
+
         def delete(key):
             cache.pop(key, None)
+            untag(key)
+
+        def locked_delete(key):
+            lock.acquire()
+            try:
+                delete(key)
+            finally:
+                lock.release()
+
+        def purge_tag(tag):
+            # delete all objects which had ``tag`` in their Surrogate-Key header
+            lock.acquire()
+            try:
+                keys = tags.pop(tag, {})
+                for key in keys:
+                    delete(key)
+                return len(keys)
+            finally:
+                lock.release()
 
         self.get = get
         self.set = locked_set
-        self.delete = delete
+        self.delete = locked_delete
+        self.purge_tag = purge_tag
 
 #
 # The middleware
@@ -168,19 +420,127 @@ class MiddleWare(object):
             policy = _POLICIES[policy]
         self.policy = policy
         self.http = policy.http()
+        self.limiter = policy.limiter()
+        # include URLs of pages, learned for prefetching
+        self._page_includes = LRUCache(max_object_size=None)
+        # fetchable esi:inline fragments
+        self._inline_fragments = None
+        if policy.inline_fragments:
+            self._inline_fragments = LRUCache(maxsize=policy.inline_fragments)
+        # threads prefetching includes, each with it's own httplib2.Http as
+        # they are not thread safe
+        self._workers = _WorkerPool(policy.prefetch_threads, policy.http)
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+        self.prefetch_wasted = 0
 
     def __call__(self, environ, start_response):
         req = webob.Request(environ)
+        policy = self.policy
+        context = _fetch_context(req, self)
+        context.inline_fragments = self._inline_fragments
+        if policy.trace or (self.debug and policy.trace_header
+                            and policy.trace_header in req.headers):
+            context.trace = _Trace(req.url)
+        composite_etag = policy.composite_etag
+        if composite_etag:
+            context.validators = []
+        if policy.prefetch:
+            context.included = []
+            urls = self._page_includes.get(req.path_url)
+            if urls:
+                context.prefetched = self._prefetch(urls, context)
+            started = len(context.prefetched)
         resp = req.get_response(self.app)
+        if context.trace is not None:
+            context.trace.root['app'] = context.trace.now()
         if resp.content_type == 'text/html' and resp.status_int == 200:
-            new_body = self._process(resp.body, req)
-            if new_body is not None:
-                resp.body = new_body
+            parts = self._process(resp.body, req)
+            if policy.prefetch:
+                self._learn_includes(req, context, started)
+            if parts is not None:
+                not_modified = False
+                if composite_etag:
+                    # the validators of the page no longer apply to the body
+                    validators = context.validators
+                    if context.variables is not None:
+                        # the body also depends on the ESI variables used
+                        validators = validators + context.variables.used()
+                    etag = _composite_etag(resp, validators)
+                    resp.last_modified = None
+                    resp.etag = None
+                    if etag is not None:
+                        resp.headers['ETag'] = 'W/"%s"' % etag
+                        not_modified = etag in req.if_none_match
+                if not_modified:
+                    # no need to even assemble the body
+                    resp.status_int = 304
+                    resp.app_iter = []
+                    resp.content_length = None
+                else:
+                    resp.body = b''.join(parts)
+        if context.trace is not None:
+            self._output_trace(context.trace, req, resp)
         return resp(environ, start_response)
 
+    def _output_trace(self, trace, req, resp):
+        policy = self.policy
+        root = trace.root
+        root['end'] = trace.now()
+        root['status'] = resp.status_int
+        if resp.status_int == 200 and resp.content_length is not None:
+            # don't read streamed responses into memory
+            root['bytes'] = resp.content_length
+        output = policy.trace_output
+        if output == 'header':
+            resp.headers[policy.trace_header or 'X-ESI-Trace'] = trace.to_json()
+        elif output == 'comment':
+            if resp.content_type == 'text/html' and resp.status_int == 200:
+                # -- is not allowed in a comment
+                comment = trace.to_json().replace('--', '-\\u002d')
+                resp.body += ('<!-- esi trace: %s -->' % comment).encode('utf-8')
+        else:
+            output(root, req)
+
     def _process(self, body, req):
         commented = self._commented(body)
-        return self._process_include(body, req, comments=commented)
+        return self._process_parts(body, req, comments=commented)
+
+    def _prefetch(self, urls, context):
+        # start fetching urls in the background, return {url: _Future}
+        futures = {}
+        for orig_url in urls:
+            url = urlsplit(orig_url)
+            if context.require_ssl and url.scheme != 'https':
+                continue
+            headers = context.headers(orig_url, url)
+            future = self._workers.submit(self._pooled_fetch, orig_url,
+                                          _normalize_host(url.netloc, url.scheme), headers)
+            if future is None:
+                # all threads are busy, fetch the rest when needed
+                break
+            futures[orig_url] = future
+        return futures
+
+    def _learn_includes(self, req, context, started):
+        # remember the includes of the page for the next request and update
+        # the statistics
+        included = context.included
+        # the prefetched includes which were used were removed
+        wasted = len(context.prefetched)
+        hits = started - wasted
+        self.prefetch_wasted += wasted
+        self.prefetch_hits += hits
+        # prefetched includes may also have been used as alt
+        self.prefetch_misses += max(0, len(included) - hits)
+        urls = []
+        for url in included:
+            if url not in urls:
+                urls.append(url)
+        self._page_includes.set(req.path_url, tuple(urls[:self.policy.prefetch]))
+
+    def _pooled_fetch(self, http, orig_url, netloc, headers):
+        return _fetch(orig_url, netloc, headers, http, self.limiter)
 
     def _commented(self, body):
         # identify parts of body which are comments
@@ -205,11 +565,26 @@ class MiddleWare(object):
             comments.append((match.start(), match.end() + 1))
         return tuple(comments)
 
-    def _process_include(self, body, req, level=0, comments=()):
+    def _process_include(self, body, req, level=0, comments=(), source=None, substitute=False,
+                         shared=True):
+        parts = self._process_parts(body, req, level=level, comments=comments, source=source,
+                                    substitute=substitute, shared=shared)
+        if parts is None:
+            return None
+        return b''.join(parts)
+
+    def _process_parts(self, body, req, level=0, comments=(), source=None, substitute=False,
+                       shared=True):
+        # like _process_include, but returns a list of the parts of the new
+        # body. ``source`` is the url of the include body comes from, None
+        # for the page. If ``substitute``, ESI variables are replaced in the
+        # text between the ESI elements, after finding them so that the
+        # values cannot add markup. Unless ``shared``, body depends on ESI
+        # variables and its includes are not learned
         debug = self.debug
         policy = self.policy
         comments = list(comments)
-        require_ssl = not (req.environ['wsgi.url_scheme'] == 'http')
+        context = _fetch_context(req, self)
         if debug and policy.max_nested_includes is not None and level > policy.max_nested_includes:
             raise RecursionError('Too many nested includes', level, body)
         c_start = c_end = None
@@ -218,8 +593,11 @@ class MiddleWare(object):
         # process the includes
         index = 0
         new = []
-        matches = _re_include.finditer(body)
+        matches = _re_esi.finditer(body)
         for match in matches:
+            if match.start() < index:
+                # inside a block we already processed
+                continue
             if c_end is not None:
                 while c_end is not None and c_end < match.end():
                     # remove comments which we have passed
@@ -231,7 +609,13 @@ class MiddleWare(object):
                     if c_start < match.start() and c_end > match.end():
                         continue
             # add section before current match to new body
-            new.append(body[index:match.start()])
+            new.append(self._substitute_text(body[index:match.start()], req, substitute))
+            block = match.group('block') or match.group('inline')
+            if block is not None:
+                new_content, index = self._process_block(block, body, match, req, level, source,
+                                                         substitute, shared)
+                new.append(new_content)
+                continue
             if match.group('other') or not match.group('src'):
                 if debug:
                     raise InvalidESIMarkup("Invalid ESI markup: %s" % body[match.start():match.end()])
@@ -239,34 +623,238 @@ class MiddleWare(object):
                 index = match.end()
                 continue
             # get content to insert
+            src = match.group('src')
+            alt = match.group('alt')
+            # learn the includes which are the same for all users
+            shared_src = shared and b'$(' not in src
+            learn = context.included is not None and shared_src
+            if b'$(' in src:
+                src = _substitute_variables(src, _request_variables(req, context), url=True)
+            if alt and b'$(' in alt:
+                alt = _substitute_variables(alt, _request_variables(req, context), url=True)
+            trace = context.trace
+            if trace is not None:
+                node = trace.enter()
             try:
-                new_content = _include_url(match.group('src'), req, require_ssl, policy.chase_redirect, self.http)
-            except:
-                if match.group('alt'):
-                    try:
-                        new_content = _include_url(match.group('alt'), req, require_ssl, policy.chase_redirect, self.http)
-                    except:
-                        if match.group('onerror') == b'continue':
-                            new_content = b''
-                        else:
-                            raise
-                elif match.group('onerror') == b'continue':
-                    new_content = b''
-                else:
-                    raise
-            if new_content:
-                # recurse to process any includes in the new content
-                new_commented = self._commented(new_content)
-                p = self._process_include(new_content, req, comments=new_commented, level=level + 1)
-                if p is not None:
-                    new_content = p
+                new_content, url = self._include(src, alt, match.group('onerror'), context, learn)
+                if new_content:
+                    # recurse to process any includes in the new content
+                    new_commented = self._commented(new_content)
+                    p = self._process_include(new_content, req, comments=new_commented, level=level + 1,
+                                              source=url, shared=shared_src)
+                    if p is not None:
+                        new_content = p
+            finally:
+                if trace is not None:
+                    trace.exit(node)
             new.append(new_content)
             # update index
             index = match.end()
-        if not index:
+        if not index and not substitute:
             return None
-        new.append(body[index:])
-        return b''.join(new)
+        new.append(self._substitute_text(body[index:], req, substitute))
+        return new
+
+    def _substitute_text(self, text, req, substitute):
+        # the text between ESI elements
+        if substitute and b'$(' in text:
+            return _substitute_variables(text, _request_variables(req, _fetch_context(req, self)))
+        return text
+
+    def _include(self, src, alt, onerror, context, learn=False):
+        # get the content of src, or alt if that fails, and the url it came
+        # from. If ``learn``, src is added to the includes of the page if it
+        # succeeds
+        trace = context.trace
+        try:
+            content = _include_url(src, context, self.http, self.limiter)
+        except:
+            if trace is not None:
+                trace.error(sys.exc_info()[1])
+            if alt:
+                if trace is not None:
+                    trace.fallback('alt')
+                try:
+                    content = _include_url(alt, context, self.http, self.limiter)
+                    return content, _resolve(context.base_url, alt)[0]
+                except:
+                    if trace is not None:
+                        trace.error(sys.exc_info()[1])
+                    if onerror == b'continue':
+                        if trace is not None:
+                            trace.fallback('continue')
+                        return b'', None
+                    raise
+            elif onerror == b'continue':
+                if trace is not None:
+                    trace.fallback('continue')
+                return b'', None
+            raise
+        url = _resolve(context.base_url, src)[0]
+        if learn:
+            context.included.append(url)
+        return content, url
+
+    def _process_block(self, block, body, match, req, level, source=None, substitute=False,
+                       shared=True):
+        # process the esi:choose, esi:vars, esi:try or esi:inline element
+        # opened by ``match``, return the new content and the index of the
+        # end of the element. The content of all but esi:inline depends on
+        # ESI variables or on the success of includes, so is not ``shared``
+        end = _find_end(body, block, match.end())
+        if end is None:
+            if self.debug:
+                raise InvalidESIMarkup("Unclosed ESI markup: %s" % body[match.start():match.end()])
+            # silently ignore the opening tag
+            return match.group(0), match.end()
+        content = body[match.end():end[0]]
+        if block == b'try':
+            return self._try(content, req, level, source, substitute), end[1]
+        if block == b'choose':
+            content = self._choose(content, req)
+            shared = False
+        elif block == b'vars':
+            substitute = True
+            shared = False
+        else:
+            self._inline(content, match.group('attributes') or b'', req, source)
+        if content:
+            p = self._process_include(content, req, comments=self._commented(content), level=level,
+                                      source=source, substitute=substitute, shared=shared)
+            if p is not None:
+                content = p
+        return content, end[1]
+
+    def _inline(self, body, attributes, req, source=None):
+        # keep the fragment ``body`` of an esi:inline to serve includes of
+        # its name, if it is in the page or an include from ``source`` on the
+        # same host as the name. It is never found in the values of variables,
+        # they are replaced after processing the ESI markup
+        name = fetchable = None
+        for match in _re_inline_attribute.finditer(attributes):
+            if match.group('name'):
+                name = match.group('name')
+            elif match.group('fetchable'):
+                fetchable = match.group('fetchable')
+            elif self.debug:
+                raise InvalidESIMarkup("Invalid ESI markup: <esi:inline%s>" % attributes)
+        if not name:
+            if self.debug:
+                raise InvalidESIMarkup("Invalid ESI markup: <esi:inline%s>" % attributes)
+            return
+        context = _fetch_context(req, self)
+        url, split = _resolve(context.base_url, name)
+        if source is not None:
+            source = urlsplit(source)
+            if (source.scheme, source.netloc.lower()) != (split.scheme, split.netloc.lower()):
+                # includes cannot replace the content of other hosts
+                return
+        context.inlined[url] = body
+        if fetchable == b'yes' and context.inline_fragments is not None:
+            fragment = _InlineFragment(body)
+            fragment.expires = _now() + self.policy.inline_fragment_ttl
+            context.inline_fragments.set(url, fragment)
+
+    def _choose(self, body, req):
+        # return the content of the first esi:when with a true test, or of
+        # esi:otherwise
+        otherwise = None
+        index = 0
+        while 1:
+            match = _re_when.search(body, index)
+            if match is None:
+                break
+            tag = b'otherwise' if match.group('test') is None else b'when'
+            end = _find_end(body, tag, match.end())
+            if end is None:
+                if self.debug:
+                    raise InvalidESIMarkup("Unclosed ESI markup: %s" % body[match.start():match.end()])
+                break
+            index = end[1]
+            if tag == b'otherwise':
+                if otherwise is None:
+                    otherwise = body[match.end():end[0]]
+            elif self._test(match.group('test'), req):
+                return body[match.end():end[0]]
+        return otherwise or b''
+
+    def _try(self, body, req, level, source=None, substitute=False):
+        # process esi:attempt, or esi:except if that fails
+        branches = {}
+        index = 0
+        while 1:
+            match = _re_try.search(body, index)
+            if match is None:
+                break
+            tag = match.group('tag')
+            end = _find_end(body, tag, match.end())
+            if end is None:
+                if self.debug:
+                    raise InvalidESIMarkup("Unclosed ESI markup: %s" % body[match.start():match.end()])
+                break
+            branches.setdefault(tag, body[match.end():end[0]])
+            index = end[1]
+        attempt = branches.get(b'attempt')
+        except_ = branches.get(b'except', b'')
+        if attempt is None:
+            if self.debug:
+                raise InvalidESIMarkup("Missing esi:attempt: %s" % body)
+            return b''
+        speculative = self._speculate_except(attempt, except_, req)
+        trace = _fetch_context(req, self).trace
+        if trace is not None:
+            node = trace.enter('try')
+        try:
+            new = self._process_include(attempt, req, comments=self._commented(attempt), level=level,
+                                        source=source, substitute=substitute, shared=False)
+        except (InvalidESIMarkup, RecursionError):
+            raise
+        except Exception:
+            if trace is not None:
+                trace.fallback('except')
+            new = self._process_include(except_, req, comments=self._commented(except_), level=level,
+                                        source=source, substitute=substitute, shared=False)
+            if new is None:
+                new = except_
+        else:
+            if new is None:
+                new = attempt
+        finally:
+            if trace is not None:
+                trace.exit(node)
+            # forget the speculative fetches we did not use
+            prefetched = _fetch_context(req, self).prefetched
+            for url in speculative:
+                prefetched.pop(url, None)
+        return new
+
+    def _speculate_except(self, attempt, except_, req):
+        # start fetching the includes of esi:except if esi:attempt includes
+        # from a slow or unreliable host, return the urls
+        hosts = self.policy.speculative_except_hosts
+        if not hosts or not except_:
+            return ()
+        context = _fetch_context(req, self)
+        hosts = set([_normalize_host(host) for host in hosts])
+        for url in _include_urls(attempt, req, context):
+            url = urlsplit(url)
+            if _normalize_host(url.netloc, url.scheme) in hosts:
+                break
+        else:
+            return ()
+        prefetched = context.prefetched
+        urls = [url for url in _include_urls(except_, req, context) if url not in prefetched]
+        prefetched.update(self._prefetch(urls, context))
+        return urls
+
+    def _test(self, expression, req):
+        try:
+            test = _compile_expression(expression)
+        except InvalidESIMarkup:
+            if self.debug:
+                raise
+            return False
+        return bool(test(_request_variables(req, _fetch_context(req, self))))
 
 #
 # Exceptions we can raise
@@ -303,6 +891,326 @@ _re_include = re.compile(br'''<esi:include'''
 
 _re_comment = re.compile(br'''<!--esi.*?--''', flags=re.DOTALL)
 
+#: Find all the ESI elements we process in a single scan of the body
+_re_esi = re.compile(br'''(?:''' + _re_include.pattern + br''')'''
+                     br'''|<esi:(?P<block>choose|vars|try)\s*>'''
+                     br'''|<esi:(?P<inline>inline)(?P<attributes>\s[^>]*)?>''')
+
+_re_inline_attribute = re.compile(br'''\s+(?:name=["']?(?P<name>[^"'\s]*)["']?'''
+                                  br'''|fetchable=["']?(?P<fetchable>[^"'\s]*)["']?'''
+                                  br'''|(?P<other>[^\s>]+))''')
+
+_re_try = re.compile(br'''<esi:(?P<tag>attempt|except)\s*>''')
+
+_re_when = re.compile(br'''<esi:when\s+test=(["'])(?P<test>.*?)\1\s*>'''
+                      br'''|<esi:otherwise\s*>''', flags=re.DOTALL)
+
+_re_block_tags = dict((name, re.compile(br'''<(/?)esi:''' + name + br'''(?:\s[^>]*)?>'''))
+                      for name in (b'choose', b'vars', b'when', b'otherwise',
+                                   b'try', b'attempt', b'except', b'inline'))
+
+def _include_urls(body, req, context):
+    """Return the absolute urls of the src of the esi:include tags in ``body``"""
+    urls = []
+    for match in _re_include.finditer(body):
+        src = match.group('src')
+        if not src or match.group('other'):
+            continue
+        if b'$(' in src:
+            src = _substitute_variables(src, _request_variables(req, context), url=True)
+        urls.append(_resolve(req.path_url, src)[0])
+    return urls
+
+def _find_end(body, name, index):
+    """
+    Return the start and end of the tag closing the esi:``name`` element
+    opened just before ``index`` in ``body`` or None if it is not closed.
+    """
+    depth = 1
+    for match in _re_block_tags[name].finditer(body, index):
+        if match.group(1):
+            depth -= 1
+            if not depth:
+                return match.start(), match.end()
+        else:
+            depth += 1
+    return None
+
+#
+# ESI Variables and expressions
+#
+
+_re_variable = re.compile(br'''\$\((?P<name>\w+)'''
+                          br'''(?:\{(?P<key>[^}]*)\})?'''
+                          br'''(?:\|(?P<default>'[^']*'|[^)]*))?\)''')
+
+def _unquote(value):
+    if len(value) > 1 and value[:1] == value[-1:] and value[:1] in (b"'", b'"'):
+        return value[1:-1]
+    return value
+
+class _Variables(object):
+    """The values of ESI variables for a request"""
+
+    def __init__(self, req):
+        self.req = req
+        self._values = {}
+
+    def __call__(self, name, key=None, default=None):
+        """Return the value of variable ``name``, ``key`` selects a part of it"""
+        value = self._values.get((name, key), _marker)
+        if value is _marker:
+            value = self._values[(name, key)] = self._lookup(name, key)
+        if value is None or value == '':
+            return default if default is not None else ''
+        return value
+
+    def used(self):
+        """Return ``(variable, value)`` of the variables used, sorted"""
+        used = []
+        for (name, key), value in self._values.items():
+            if key is not None:
+                name = '%s{%s}' % (name, key)
+            used.append(('$(%s)' % name, json.dumps(value)))
+        used.sort()
+        return used
+
+    def _lookup(self, name, key):
+        req = self.req
+        if name == 'HTTP_COOKIE':
+            if key is not None:
+                try:
+                    return req.cookies.get(key)
+                except UnicodeDecodeError:
+                    # not UTF-8, as if there were no cookies
+                    return None
+            return req.headers.get('Cookie')
+        if name == 'QUERY_STRING':
+            if key is not None:
+                try:
+                    return req.GET.get(key)
+                except UnicodeDecodeError:
+                    # not UTF-8, as if there was no query string
+                    return None
+            return req.query_string
+        if name == 'HTTP_ACCEPT_LANGUAGE' and key is not None:
+            key = key.lower()
+            for language in req.headers.get('Accept-Language', '').split(','):
+                language = language.split(';')[0].strip().lower()
+                if language == key or language.startswith(key + '-'):
+                    return True
+            return False
+        if name == 'HTTP_USER_AGENT' and key is not None:
+            return _user_agent(req.headers.get('User-Agent', ''), key)
+        if name.startswith('HTTP_') and key is None:
+            return req.environ.get(name)
+        return None
+
+def _user_agent(user_agent, key):
+    if key == 'browser':
+        if 'MSIE' in user_agent or 'Trident/' in user_agent:
+            return 'MSIE'
+        if user_agent.startswith('Mozilla'):
+            return 'MOZILLA'
+        return 'OTHER'
+    if key == 'os':
+        if 'Windows' in user_agent:
+            return 'WIN'
+        if 'Mac' in user_agent:
+            return 'MAC'
+        if 'Linux' in user_agent or 'X11' in user_agent or 'BSD' in user_agent:
+            return 'UNIX'
+        return 'OTHER'
+    if key == 'version':
+        match = re.search(r'^\w+/(\d+(?:\.\d+)?)', user_agent)
+        if match is not None:
+            return match.group(1)
+    return None
+
+def _request_variables(req, context):
+    if context.variables is None:
+        context.variables = _Variables(req)
+    return context.variables
+
+def _variable_args(match):
+    # the arguments to _Variables.__call__ for a match of _re_variable
+    key = match.group('key')
+    if key is not None:
+        key = _unquote(key.strip()).decode('utf-8', 'replace')
+    default = match.group('default')
+    if default is not None:
+        default = _unquote(default).decode('utf-8', 'replace')
+    return match.group('name').decode('ascii'), key, default
+
+def _text(value):
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, (int, float)):
+        return '%s' % value
+    return value
+
+#: Characters not percent encoded when the whole query string, which is
+#: already encoded, is used in a URL
+_query_string_safe = "/?:@!$&'()*+,;=%"
+
+def _substitute_variables(body, variables, url=False):
+    """
+    Replace the ESI variables in ``body`` with their values from
+    ``variables``, a _Variables, percent encoded if ``body`` is a URL.
+    """
+    def replace(match):
+        args = _variable_args(match)
+        value = _text(variables(*args)).encode('utf-8')
+        if url:
+            if args[:2] == ('QUERY_STRING', None):
+                value = quote(value, safe=_query_string_safe)
+            else:
+                value = quote(value, safe='')
+            value = value.encode('ascii')
+        return value
+    return _re_variable.sub(replace, body)
+
+_re_expression_token = re.compile(br'''\s*(?:'''
+                                  br'''(?P<variable>\$\((?:'[^']*'|[^)])*\))'''
+                                  br"|'(?P<string>[^']*)'"
+                                  br'''|(?P<number>-?\d+(?:\.\d+)?)'''
+                                  br'''|(?P<op>==|!=|<=|>=|&&|\|\||[<>!&|()])'''
+                                  br''')''')
+
+def _as_number(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _compare(op, left, right):
+    # compare numerically if both sides are numbers, else as text
+    left_number = _as_number(left)
+    right_number = _as_number(right)
+    if left_number is not None and right_number is not None:
+        left, right = left_number, right_number
+    else:
+        left, right = _text(left), _text(right)
+    return op(left, right)
+
+_comparisons = {b'==': operator.eq,
+                b'!=': operator.ne,
+                b'<': operator.lt,
+                b'<=': operator.le,
+                b'>': operator.gt,
+                b'>=': operator.ge}
+
+class _ExpressionCompiler(object):
+    """
+    Compile an ESI expression to a function taking a ``_Variables`` instance.
+
+    The functions are built once out of closures so evaluating an expression
+    costs only the variable lookups.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = tokens = []
+        index = 0
+        expression = expression.strip()
+        while index < len(expression):
+            match = _re_expression_token.match(expression, index)
+            if match is None or match.end() == index:
+                self.error()
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            index = match.end()
+        self.index = 0
+
+    def error(self):
+        raise InvalidESIMarkup("Invalid ESI expression: %s" % (self.expression, ))
+
+    def peek(self):
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+        return None, None
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            self.error()
+        self.index += 1
+        return token
+
+    def compile(self):
+        func = self.or_()
+        if self.index != len(self.tokens):
+            self.error()
+        return func
+
+    def or_(self):
+        funcs = [self.and_()]
+        while self.peek() in (('op', b'|'), ('op', b'||')):
+            self.next()
+            funcs.append(self.and_())
+        if len(funcs) == 1:
+            return funcs[0]
+        return lambda v: any(f(v) for f in funcs)
+
+    def and_(self):
+        funcs = [self.not_()]
+        while self.peek() in (('op', b'&'), ('op', b'&&')):
+            self.next()
+            funcs.append(self.not_())
+        if len(funcs) == 1:
+            return funcs[0]
+        return lambda v: all(f(v) for f in funcs)
+
+    def not_(self):
+        if self.peek() == ('op', b'!'):
+            self.next()
+            func = self.not_()
+            return lambda v: not func(v)
+        return self.comparison()
+
+    def comparison(self):
+        left = self.operand()
+        kind, value = self.peek()
+        if kind == 'op' and value in _comparisons:
+            self.next()
+            op = _comparisons[value]
+            right = self.operand()
+            return lambda v: _compare(op, left(v), right(v))
+        return left
+
+    def operand(self):
+        kind, value = self.next()
+        if kind == 'op' and value == b'(':
+            func = self.or_()
+            if self.next() != ('op', b')'):
+                self.error()
+            return func
+        if kind == 'variable':
+            match = _re_variable.match(value)
+            if match is None or match.end() != len(value):
+                self.error()
+            args = _variable_args(match)
+            return lambda v: v(*args)
+        if kind == 'string':
+            value = value.decode('utf-8', 'replace')
+        elif kind == 'number':
+            value = float(value) if b'.' in value else int(value)
+        else:
+            self.error()
+        return lambda v: value
+
+#: Compiled expressions by their text
+_expressions = _Memo(1000)
+
+def _compile_expression(expression):
+    func = _expressions.get(expression)
+    if func is None:
+        func = _expressions[expression] = _ExpressionCompiler(expression).compile()
+    return func
+
 class _HTTPError(Exception):
 
     def __init__(self, url, status):
@@ -339,24 +1247,533 @@ def _forward_all_headers_allowed(origin_host, is_ssl, url):
     return url_host == origin_host
 
 
-def _include_url(orig_url, req, require_ssl, chase_redirect, http):
-    orig_url = orig_url.decode('ascii')
-    orig_url = urljoin(req.path_url, orig_url)
-    url = urlsplit(orig_url)
-    headers = req.headers
-    if require_ssl and url.scheme != 'https':
-        raise IncludeError('SSL required, cannot include: %s' % (orig_url, ))
+class _HostMappedHttp(Http):
+    """An httplib2.Http using other connection types for some hosts or schemes"""
+
+    #: {host[:port]: connection type} for http URLs
+    connection_types = {}
+    #: {scheme: connection type} for the other URLs
+    scheme_connection_types = {}
+    #: Ask for uncompressed responses. httplib2 decompresses responses
+    #: completely, so only their compressed size could be limited.
+    uncompressed = False
+
+    def request(self, uri, *args, **kw):
+        if self.uncompressed and len(args) < 3:
+            headers = kw.get('headers')
+            if not headers or not [k for k in headers if k.lower() == 'accept-encoding']:
+                headers = dict(headers or {})
+                headers['accept-encoding'] = 'identity'
+                kw['headers'] = headers
+        if not kw.get('connection_type'):
+            url = urlsplit(uri)
+            connection_type = None
+            if url.scheme == 'http':
+                connection_type = self.connection_types.get(_normalize_host(url.netloc, url.scheme))
+            if connection_type is None:
+                connection_type = self.scheme_connection_types.get(url.scheme)
+            if connection_type is not None:
+                kw['connection_type'] = connection_type
+        return Http.request(self, uri, *args, **kw)
 
-    if _forward_all_headers_allowed(headers.get('Host'), require_ssl, url):
-        forward_headers = forward_headers_same_origin
+_default_ports = {'http': ':80', 'https': ':443'}
+
+def _normalize_host(netloc, scheme='http'):
+    """Return ``host[:port]`` of a ``scheme`` URL without the default port"""
+    netloc = netloc.lower()
+    port = _default_ports.get(scheme)
+    if port is not None and netloc.endswith(port):
+        netloc = netloc[:-len(port)]
+    return netloc
+
+class _LimitedResponse(HTTPResponse):
+    """A response which fails when reading more than ``max_size`` bytes"""
+
+    max_size = None
+    # the connection to close if the response is too large
+    connection = None
+
+    def read(self, amt=None):
+        if amt is not None:
+            return HTTPResponse.read(self, amt)
+        try:
+            if self.length is not None and self.length > self.max_size:
+                self._too_large()
+            chunks = []
+            size = 0
+            while True:
+                chunk = HTTPResponse.read(self, 65536)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > self.max_size:
+                    self._too_large()
+                chunks.append(chunk)
+            return b''.join(chunks)
+        finally:
+            self.connection = None
+
+    def _too_large(self):
+        # the rest of the response is still to be read from the socket, so
+        # the connection cannot be used again
+        self.close()
+        if self.connection is not None:
+            self.connection.close()
+        raise IncludeError('Include larger than %s bytes' % (self.max_size, ))
+
+def _limited_connection(base, max_size):
+    """
+    Return a subclass of the connection type ``base`` whose responses fail
+    when reading more than ``max_size`` bytes.
+    """
+    response_class = type('LimitedHTTPResponse', (_LimitedResponse, ), {'max_size': max_size})
+    def getresponse(self):
+        response = base.getresponse(self)
+        response.connection = self
+        return response
+    return type('Limited' + base.__name__, (base, ),
+                {'response_class': response_class, 'getresponse': getresponse})
+
+def _mapped_connection(address, max_size=None):
+    """
+    Return a subclass of HTTPConnectionWithTimeout which connects to
+    ``address``, ``'unix:/path/to/socket'`` or ``'host:port'``, instead of the
+    host it was created for. If ``max_size`` is not None, responses larger
+    than it fail.
+    """
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        def connect(self):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(path)
+            except:
+                sock.close()
+                raise
+            self.sock = sock
     else:
-        forward_headers = forward_headers_all_servers
+        host, port = address.rsplit(':', 1)
+        if host.startswith('[') and host.endswith(']'):
+            # an IPv6 address
+            host = host[1:-1]
+        port = int(port)
+        def connect(self):
+            self.sock = socket.create_connection((host, port), self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    base = HTTPConnectionWithTimeout
+    if max_size is not None:
+        base = _limited_connection(base, max_size)
+    return type('MappedHTTPConnection', (base, ), {'connect': connect})
+
 
-    headers = dict((k, v)
-                    for k, v in headers.items()
-                    if k.lower() in forward_headers)
+class _HostLimiter(object):
+    """Limit the number of concurrent requests to each host.
+
+    ``limits`` is either the limit for all hosts or a dict of limits per host,
+    hosts not in the dict are not limited. Hosts are compared without case and
+    the default port. If no connection is free after ``timeout`` seconds,
+    IncludeError is raised.
+    """
+
+    def __init__(self, limits, timeout=None):
+        self.limits = limits
+        self.timeout = timeout
+        self.timeouts = 0
+        self._lock = threading.Lock()
+        self._active = _Counter()
+        self._conditions = {}
+        self._host_limits = None
+        if isinstance(limits, dict):
+            self._host_limits = dict((_normalize_host(host), limit) for host, limit in limits.items())
+
+    def _limit(self, host):
+        if self._host_limits is not None:
+            return self._host_limits.get(host)
+        return self.limits
+
+    def acquire(self, host):
+        """Wait for a free connection to ``host``, return False if not limited"""
+        host = _normalize_host(host)
+        limit = self._limit(host)
+        if limit is None:
+            return False
+        timeout = self.timeout
+        self._lock.acquire()
+        try:
+            condition = self._conditions.get(host)
+            if condition is None:
+                condition = self._conditions[host] = threading.Condition(self._lock)
+            if timeout is not None:
+                deadline = _now() + timeout
+            while self._active[host] >= limit:
+                if timeout is not None:
+                    timeout = deadline - _now()
+                    if timeout <= 0:
+                        self.timeouts += 1
+                        raise IncludeError('Too many concurrent requests to %s' % (host, ))
+                condition.wait(timeout)
+            self._active[host] += 1
+        finally:
+            self._lock.release()
+        return True
+
+    def release(self, host):
+        host = _normalize_host(host)
+        self._lock.acquire()
+        try:
+            self._active[host] -= 1
+            if not self._active[host]:
+                del self._active[host]
+            self._conditions[host].notify()
+        finally:
+            self._lock.release()
+
+
+class _Future(object):
+    """The result of calling a function in a background thread"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = self._error = None
+
+    def result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class _WorkerPool(object):
+    """
+    Up to ``size`` threads, each with an httplib2.Http from calling ``http``,
+    running functions in the background.
+    """
 
-    resp, content = http.request(orig_url, headers=dict(headers))
+    def __init__(self, size, http):
+        self.size = size
+        self._http = http
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = 0
+        # functions waiting or running
+        self._busy = 0
+
+    def submit(self, func, *args):
+        """
+        Return a _Future of ``func(http, *args)`` or None if all threads are
+        busy.
+        """
+        with self._lock:
+            if self._busy >= self.size:
+                return None
+            self._busy += 1
+            if self._threads < self._busy:
+                self._threads += 1
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+        future = _Future()
+        self._queue.put((future, func, args))
+        return future
+
+    def _work(self):
+        http = self._http()
+        while True:
+            future, func, args = self._queue.get()
+            try:
+                future._result = func(http, *args)
+            except Exception:
+                future._error = sys.exc_info()[1]
+            with self._lock:
+                self._busy -= 1
+            future._done.set()
+
+
+class _FetchContext(object):
+    """
+    What is needed to fetch the includes of a request, computed once for all
+    of them, and what is learned while doing so.
+    """
+
+    def __init__(self, req, policy=None):
+        if policy is None:
+            policy = Policy
+        self.vary_cookies = policy.vary_cookies
+        self.vary_languages = policy.vary_languages
+        self.max_fragment_size = policy.max_fragment_size
+        self.base_url = req.path_url
+        self.require_ssl = not (req.environ['wsgi.url_scheme'] == 'http')
+        headers = req.headers
+        self.origin_host = headers.get('Host')
+        self.same_origin_headers = {}
+        self.all_servers_headers = {}
+        for k, v in headers.items():
+            k_lower = k.lower()
+            if k_lower in forward_headers_same_origin:
+                self.same_origin_headers[k] = v
+            if k_lower in forward_headers_all_servers:
+                self.all_servers_headers[k] = v
+        self._same_origin = {}
+        self._normalized = {}
+        # urls included, if learning the includes of the page
+        self.included = None
+        # validators of the includes, if computing a composite etag
+        self.validators = None
+        # {url: _Future} of includes being fetched
+        self.prefetched = {}
+        self.variables = None
+        self.trace = None
+        # {url: content} of the esi:inline fragments of the page and the
+        # store of the fetchable ones of all pages
+        self.inlined = {}
+        self.inline_fragments = None
+
+    def headers(self, orig_url, url):
+        """Return the headers to send in a request to ``orig_url``, ``url``
+        being the result of urlsplit.
+
+        The same dict is returned for many requests, it must not be changed.
+        """
+        key = (url.scheme, url.netloc)
+        same_origin = self._same_origin.get(key)
+        if same_origin is None:
+            same_origin = self._same_origin[key] = _forward_all_headers_allowed(
+                    self.origin_host, self.require_ssl, url)
+        if same_origin:
+            headers = self.same_origin_headers
+        else:
+            headers = self.all_servers_headers
+        vary = _varies.get(orig_url)
+        if vary:
+            headers = self._normalize(headers, vary)
+        return headers
+
+    def _normalize(self, headers, vary):
+        # Normalize the headers the response varies on so that the cached
+        # response can be used for more requests
+        key = (id(headers), vary)
+        normalized = self._normalized.get(key)
+        if normalized is not None:
+            return normalized
+        normalized = {}
+        for k, v in headers.items():
+            k_lower = k.lower()
+            if k_lower in vary:
+                if k_lower == 'cookie' and self.vary_cookies is not None:
+                    v = _normalize_cookie(v, self.vary_cookies)
+                elif k_lower == 'accept-language' and self.vary_languages:
+                    v = _normalize_accept_language(v, self.vary_languages)
+                if not v:
+                    continue
+            normalized[k] = v
+        self._normalized[key] = normalized
+        return normalized
+
+
+class _Trace(object):
+    """
+    A tree of the includes of a page with, for each, the url and status
+    fetched, the start and end in milliseconds since the request started,
+    the cache status, size and fallbacks used. The includes of an esi:try are
+    in a node of their own with the ``block`` and its fallback.
+    """
+
+    def __init__(self, url):
+        self.start = _now()
+        self.root = {'url': url, 'start': 0, 'includes': []}
+        self.stack = [self.root]
+
+    def now(self):
+        return round((_now() - self.start) * 1000, 1)
+
+    def enter(self, block=None):
+        node = {'start': self.now(), 'includes': []}
+        if block is not None:
+            node['block'] = block
+        self.stack[-1]['includes'].append(node)
+        self.stack.append(node)
+        return node
+
+    def exit(self, node):
+        node['end'] = self.now()
+        if not node['includes']:
+            del node['includes']
+        self.stack.pop()
+
+    def fetched(self, url, resp, content, prefetched):
+        node = self.stack[-1]
+        node['url'] = url
+        node['status'] = resp.status
+        node['bytes'] = len(content)
+        if prefetched:
+            node['cache'] = 'prefetch'
+        else:
+            node['cache'] = 'hit' if getattr(resp, 'fromcache', False) else 'miss'
+
+    def inlined(self, url, content):
+        node = self.stack[-1]
+        node['url'] = url
+        node['bytes'] = len(content)
+        node['cache'] = 'inline'
+
+    def error(self, error):
+        self.stack[-1]['error'] = error.__class__.__name__
+
+    def fallback(self, fallback):
+        self.stack[-1]['fallback'] = fallback
+
+    def to_json(self):
+        return json.dumps(self.root, separators=(',', ':'), sort_keys=True)
+
+
+def _fetch_context(req, middleware):
+    """
+    Return the _FetchContext of ``middleware`` for ``req``. Each middleware
+    has it's own, as the environ is passed on to the wrapped app which can be
+    another middleware.
+    """
+    key = 'wesgi.context.%s' % id(middleware)
+    context = req.environ.get(key)
+    if context is None:
+        context = req.environ[key] = _FetchContext(req, middleware.policy)
+    return context
+
+
+#: url -> the headers in the Vary header of the last response
+_varies = _Memo(10000)
+
+def _normalize_cookie(value, names):
+    """Keep only the cookies in ``names``, sorted by name"""
+    cookies = []
+    for cookie in value.split(';'):
+        name = cookie.split('=', 1)[0].strip()
+        if name in names:
+            cookies.append((name, cookie.strip()))
+    cookies.sort()
+    return '; '.join([cookie for name, cookie in cookies])
+
+def _normalize_accept_language(value, languages):
+    """
+    Return the languages in an Accept-Language header ordered by preference,
+    lowercased and without quality values. If ``languages`` is a sequence
+    only the preferred one of ``languages`` is returned.
+    """
+    accepted = []
+    for i, language in enumerate(value.split(',')):
+        language = language.strip().lower().split(';')
+        quality = 1.0
+        for param in language[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if language[0] and quality > 0:
+            accepted.append((-quality, i, language[0]))
+    accepted.sort()
+    accepted = [language for q, i, language in accepted]
+    if languages is True:
+        return ','.join(accepted)
+    for language in accepted:
+        for available in languages:
+            available_lower = available.lower()
+            if language == '*' or available_lower == language \
+                    or available_lower.startswith(language + '-') \
+                    or language.startswith(available_lower + '-'):
+                return available
+    return ''
+
+
+#: (base url, url) -> (absolute url, urlsplit result). The base url is None
+#: for absolute urls and only the scheme and host for urls starting with /,
+#: so that pages at many urls share them.
+_resolved_urls = _Memo(10000)
+
+def _resolve(base_url, orig_url):
+    """Resolve ``orig_url``, bytes from an ESI tag, relative to ``base_url``"""
+    if orig_url.startswith((b'http://', b'https://')):
+        key = (None, orig_url)
+    elif orig_url.startswith(b'/') and not orig_url.startswith(b'//'):
+        end = base_url.find('/', base_url.find('//') + 2)
+        if end != -1:
+            base_url = base_url[:end]
+        key = (base_url, orig_url)
+    else:
+        key = (base_url, orig_url)
+    resolved = _resolved_urls.get(key)
+    if resolved is None:
+        url = urljoin(base_url, orig_url.decode('ascii'))
+        resolved = _resolved_urls[key] = (url, urlsplit(url))
+    return resolved
+
+
+def _fetch(orig_url, netloc, headers, http, limiter=None):
+    if limiter is not None and limiter.acquire(netloc):
+        try:
+            return http.request(orig_url, headers=headers)
+        finally:
+            limiter.release(netloc)
+    return http.request(orig_url, headers=headers)
+
+
+def _include_url(orig_url, context, http, limiter=None):
+    orig_url, url = _resolve(context.base_url, orig_url)
+    content = context.inlined.get(orig_url)
+    if content is None and context.inline_fragments is not None:
+        content = context.inline_fragments.get(orig_url)
+        if content is not None and content.expires < _now():
+            context.inline_fragments.delete(orig_url)
+            content = None
+        if content is not None and context.validators is not None:
+            # from another page, so no validator
+            context.validators.append((orig_url, None))
+    if content is not None:
+        if context.trace is not None:
+            context.trace.inlined(orig_url, content)
+        return content
+    if context.require_ssl and url.scheme != 'https':
+        raise IncludeError('SSL required, cannot include: %s' % (orig_url, ))
+
+    future = context.prefetched.pop(orig_url, None)
+    if future is not None:
+        resp, content = future.result()
+    else:
+        resp, content = _fetch(orig_url, _normalize_host(url.netloc, url.scheme),
+                               context.headers(orig_url, url), http, limiter)
+    if context.trace is not None:
+        context.trace.fetched(orig_url, resp, content, future is not None)
+    vary = resp.get('vary')
+    if vary:
+        _varies[orig_url] = frozenset(vary.lower().replace(' ', '').split(','))
+    else:
+        # another thread may clear _varies at any time
+        _varies.pop(orig_url, None)
     if resp.status == 200:
+        # also catches cached or compressed responses
+        if context.max_fragment_size is not None and len(content) > context.max_fragment_size:
+            raise IncludeError('Include larger than %s bytes: %s' % (context.max_fragment_size, orig_url))
+        if context.validators is not None:
+            context.validators.append((orig_url, resp.get('etag') or resp.get('last-modified')))
         return content
     raise _HTTPError(orig_url, resp.status)
+
+
+def _composite_etag(resp, validators):
+    """
+    Return an ETag for a page assembled from the response ``resp`` and
+    includes with ``validators``, a list of ``(url, etag or last-modified)``.
+
+    None is returned if the page or any include has no validator.
+    """
+    validator = resp.headers.get('ETag') or resp.headers.get('Last-Modified')
+    if not validator:
+        return None
+    parts = [validator]
+    for url, validator in validators:
+        if not validator:
+            return None
+        parts.append(url)
+        parts.append(validator)
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
@@ -0,0 +1,377 @@
+"""Record the includes of real traffic and replay it against the middleware.
+
+To record, trace all requests and write the traces to a file:
+
+    policy.trace = True
+    policy.trace_output = Recorder(open('traffic.jsonl', 'a'))
+
+Each line has the URL and headers of a page, with sensitive headers redacted,
+and its trace: the includes, their size, status and latency.
+
+To replay, run:
+
+    python -m wesgi.replay traffic.jsonl --concurrency 8 --cache-size 1000
+
+Pages and includes of the recorded sizes are generated and served by a local
+origin server which waits for a latency sampled from those recorded for each
+URL. The requests are sent to a middleware with the ``host_map`` policy option
+pointing all hosts to that server. Throughput, page latency, cache hit ratio
+and memory use are reported.
+"""
+import sys
+import copy
+import json
+import time
+import random
+import threading
+try:
+    from urllib.parse import urlsplit
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Python 2
+    from urlparse import urlsplit
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import webob
+
+import wesgi
+
+__all__ = ['Recorder', 'load', 'replay', 'format_report', 'main']
+
+#: Request headers which are not recorded
+redacted_headers = set(['cookie', 'authorization', 'proxy-authorization'])
+
+class Recorder(object):
+    """
+    A ``trace_output`` for policies writing the traces of requests to
+    ``file``, a line of JSON each. The lines are written as text, ``file`` can
+    be a text file from ``io``.
+    """
+
+    def __init__(self, file, redact=redacted_headers):
+        self.file = file
+        self.redact = redact
+        self._lock = threading.Lock()
+
+    def __call__(self, trace, request):
+        headers = {}
+        for k, v in request.headers.items():
+            if k.lower() in self.redact:
+                v = 'redacted'
+            headers[k] = v
+        line = json.dumps({'url': request.url, 'headers': headers, 'trace': trace},
+                          separators=(',', ':'), sort_keys=True)
+        if isinstance(line, bytes):
+            # Python 2, write text to files from io too
+            line = line.decode('ascii')
+        with self._lock:
+            self.file.write(line + u'\n')
+            self.file.flush()
+
+def load(file):
+    """Return the records in ``file``, written by a Recorder"""
+    return [json.loads(line) for line in file if line.strip()]
+
+#
+# The origin generating pages and includes like the recorded ones
+#
+
+def _http(url):
+    # the origin does not do SSL
+    if url.startswith('https:'):
+        return 'http:' + url[len('https:'):]
+    return url
+
+def _duration(node):
+    return node.get('end', node['start']) - node['start']
+
+class _Resource(object):
+    """A page or include which was recorded"""
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        # in milliseconds
+        self.latencies = []
+
+    def latency(self, random):
+        if not self.latencies:
+            return 0
+        return random.choice(self.latencies)
+
+def _includes(nodes):
+    # the include nodes, also those in the nodes of esi:try blocks
+    includes = []
+    for node in nodes:
+        if 'block' in node:
+            includes.extend(_includes(node.get('includes', ())))
+        else:
+            includes.append(node)
+    return includes
+
+def _markup(includes):
+    return b''.join([('<esi:include src="%s"/>' % _http(node['url'])).encode('ascii')
+                     for node in _includes(includes) if 'url' in node])
+
+def _filled(markup, size):
+    # some content of ``size`` bytes containing ``markup``
+    return markup + b'x' * max(0, size - len(markup))
+
+def _recorded_bytes(includes):
+    # the bytes of includes, and their includes, as fetched
+    return sum([node.get('bytes', 0) + _recorded_bytes(node.get('includes', ()))
+                for node in includes])
+
+class _Origin(object):
+    """The pages and includes of the recorded traffic"""
+
+    def __init__(self, records):
+        self.pages = {}
+        self.includes = {}
+        for record in records:
+            trace = record['trace']
+            includes = trace.get('includes', ())
+            url = _http(record['url'])
+            page = self.pages.get(url)
+            if page is None:
+                # the trace has the size of the assembled page
+                size = trace.get('bytes', 0) - _recorded_bytes(includes)
+                page = self.pages[url] = _Resource(trace.get('status', 200),
+                                                   _filled(_markup(includes), size))
+            if 'app' in trace:
+                page.latencies.append(trace['app'])
+            self._add(includes)
+
+    def _add(self, includes):
+        for node in _includes(includes):
+            if 'url' not in node or node.get('cache') == 'inline':
+                continue
+            url = _http(node['url'])
+            children = node.get('includes', ())
+            include = self.includes.get(url)
+            if include is None:
+                # includes which could not be fetched at all fail
+                status = node.get('status', 503)
+                include = self.includes[url] = _Resource(status,
+                        _filled(_markup(children), node.get('bytes', 0)))
+            if node.get('cache') == 'miss' and 'end' in node:
+                # the time to fetch it, without its includes
+                include.latencies.append(max(0, _duration(node) - sum(map(_duration, children))))
+            self._add(children)
+
+    def hosts(self):
+        return set([urlsplit(url).netloc for url in self.includes])
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        include = server.origin.includes.get('http://%s%s' % (self.headers['Host'], self.path))
+        if include is None:
+            status, body = 404, b''
+        else:
+            time.sleep(include.latency(server.random) / 1000.0)
+            status, body = include.status, include.body
+        with server.lock:
+            server.requests += 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        if server.max_age is not None:
+            self.send_header('Cache-Control', 'max-age=%s' % server.max_age)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def _app(origin, random):
+    # the application generating the recorded pages
+    def app(environ, start_response):
+        page = origin.pages.get(webob.Request(environ).url)
+        if page is None:
+            response = webob.Response(status=404)
+        else:
+            time.sleep(page.latency(random) / 1000.0)
+            response = webob.Response(page.body, status=page.status, content_type='text/html')
+        return response(environ, start_response)
+    return app
+
+class _ThreadLocalHttp(object):
+    """An httplib2.Http for each thread, they are not thread safe"""
+
+    def __init__(self, policy):
+        self._policy = policy
+        self._local = threading.local()
+        self._created = []
+
+    def request(self, *args, **kw):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = self._policy.http()
+            self._created.append(http)
+        return http.request(*args, **kw)
+
+    def close(self):
+        for http in self._created:
+            for conn in http.connections.values():
+                conn.close()
+
+#
+# Replaying
+#
+
+def _percentile(values, percent):
+    # ``values`` must be sorted
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+def replay(records, policy='default', concurrency=1, requests=None, max_age=None, seed=None):
+    """
+    Replay the requests in ``records`` against a middleware with ``policy``
+    using ``concurrency`` threads and return a report.
+
+    ``requests`` is the number of requests to send, by default one for each
+    record, cycling through them. ``max_age`` is sent in the ``Cache-Control``
+    header of the includes so that they can be cached.
+    """
+    if isinstance(policy, basestring):
+        policy = wesgi._POLICIES[policy]
+    if requests is None:
+        requests = len(records)
+    rand = random.Random(seed)
+    origin = _Origin(records)
+    server = _Server(('127.0.0.1', 0), _Handler)
+    server.origin = origin
+    server.random = rand
+    server.max_age = max_age
+    server.requests = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        address = '%s:%s' % server.server_address
+        policy = copy.copy(policy)
+        policy.trace = False
+        policy.host_map = dict(policy.host_map or {})
+        for host in origin.hosts():
+            policy.host_map[host] = address
+        mw = wesgi.MiddleWare(_app(origin, rand), policy=policy, debug=False)
+        mw.http = _ThreadLocalHttp(policy)
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        sent = iter(range(requests))
+        def work():
+            while True:
+                with lock:
+                    i = next(sent, None)
+                if i is None:
+                    return
+                record = records[i % len(records)]
+                headers = dict((k, v) for k, v in record['headers'].items()
+                               if v != 'redacted')
+                req = webob.Request.blank(_http(record['url']), headers=headers)
+                started = time.time()
+                try:
+                    status = req.get_response(mw).status_int
+                except Exception:
+                    status = None
+                latency = (time.time() - started) * 1000
+                with lock:
+                    latencies.append(latency)
+                    if status != 200:
+                        errors[0] += 1
+        started = time.time()
+        workers = [threading.Thread(target=work) for i in range(concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        duration = time.time() - started
+        mw.http.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    latencies.sort()
+    report = {'requests': requests,
+              'errors': errors[0],
+              'concurrency': concurrency,
+              'seconds': round(duration, 3),
+              'requests_per_second': round(requests / duration, 1) if duration else None,
+              'p50_ms': _percentile(latencies, 50),
+              'p90_ms': _percentile(latencies, 90),
+              'p99_ms': _percentile(latencies, 99),
+              'max_ms': latencies[-1] if latencies else None,
+              'origin_requests': server.requests,
+              'cache_hit_ratio': None,
+              'max_rss_kb': None}
+    cache = policy.cache
+    if cache is not None and hasattr(cache, 'hits'):
+        lookups = cache.hits + cache.misses
+        if lookups:
+            report['cache_hit_ratio'] = round(cache.hits / float(lookups), 3)
+    if resource is not None:
+        # kilobytes on Linux, bytes on Mac OS X
+        report['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return report
+
+def format_report(report):
+    lines = []
+    for key in ('requests', 'errors', 'concurrency', 'seconds', 'requests_per_second',
+                'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'origin_requests',
+                'cache_hit_ratio', 'max_rss_kb'):
+        value = report[key]
+        if isinstance(value, float):
+            value = '%.3f' % value
+        lines.append('%-20s %s' % (key + ':', value))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    # optparse, argparse is not available in Python 2.6
+    import optparse
+    parser = optparse.OptionParser(prog='python -m wesgi.replay', usage='%prog [options] file',
+                                   description='Replay recorded traffic against the middleware '
+                                               'from file, written by a Recorder')
+    parser.add_option('--policy', default='default', choices=sorted(wesgi._POLICIES))
+    parser.add_option('--concurrency', type='int', default=1)
+    parser.add_option('--requests', type='int', default=None,
+                      help='number of requests, by default one per recorded request')
+    parser.add_option('--max-age', type='int', default=None,
+                      help='seconds the includes can be cached')
+    parser.add_option('--cache-size', type='int', default=None,
+                      help='cache up to this many includes in a LRUCache')
+    parser.add_option('--seed', type='int', default=None)
+    args, files = parser.parse_args(argv)
+    if len(files) != 1:
+        parser.error('expected one file')
+    with open(files[0]) as f:
+        records = load(f)
+    policy = copy.copy(wesgi._POLICIES[args.policy])
+    if args.cache_size:
+        policy.cache = wesgi.LRUCache(maxsize=args.cache_size)
+    report = replay(records, policy, concurrency=args.concurrency, requests=args.requests,
+                    max_age=args.max_age, seed=args.seed)
+    sys.stdout.write(format_report(report) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,11 @@
 import os
 from unittest import TestCase
+try:
+    from urllib.parse import urlsplit, quote
+except ImportError:
+    # Python 2
+    from urlparse import urlsplit
+    from urllib import quote
 
 import webob
 from mock import patch, Mock, call
@@ -221,6 +227,338 @@ class TestProcessInclude(TestCase):
         self.assertTrue(used < 0.01, 'Test took too long: %s seconds' % used)
 
 
+class TestChooseAndVars(TestCase):
+
+    def process(self, body, **requestkwargs):
+        mw = make_mw(http_content=b'<div>example</div>')
+        req = webob.Request.blank("/", **requestkwargs)
+        return mw._process_include(body, req)
+
+    def test_choose(self):
+        body = (b'before<esi:choose>'
+                b'<esi:when test="$(HTTP_COOKIE{group})==\'a\'">A<esi:include src="http://www.example.com"/></esi:when>'
+                b' <esi:when test="$(QUERY_STRING{page}) > 2">B</esi:when>'
+                b'<esi:otherwise>C</esi:otherwise>'
+                b'</esi:choose>after')
+        self.assertEqual(self.process(body, headers={'Cookie': 'group=a'}),
+                         b'beforeA<div>example</div>after')
+        self.assertEqual(self.process(body, headers={'Cookie': 'group=b'}),
+                         b'beforeCafter')
+        self.assertEqual(self.process(body + b'<esi:include src="http://www.example.com"/>',
+                                      query_string='page=10'),
+                         b'beforeBafter<div>example</div>')
+        # no otherwise
+        self.assertEqual(self.process(b'<esi:choose><esi:when test="1 == 2">A</esi:when></esi:choose>'),
+                         b'')
+
+    def test_nested_choose(self):
+        body = (b'<esi:choose><esi:when test="$(HTTP_HOST) == \'localhost:80\'">'
+                b'<esi:choose><esi:when test="1 == 2">A</esi:when>'
+                b'<esi:otherwise>B</esi:otherwise></esi:choose>'
+                b'</esi:when><esi:otherwise>C</esi:otherwise></esi:choose>')
+        self.assertEqual(self.process(body), b'B')
+
+    def test_vars(self):
+        body = (b'<esi:vars>$(HTTP_COOKIE{name}) $(HTTP_COOKIE{other}|\'anon\')'
+                b' $(QUERY_STRING{q}) $(HTTP_ACCEPT_LANGUAGE{de})</esi:vars> $(HTTP_COOKIE{name})')
+        self.assertEqual(self.process(body, headers={'Cookie': 'name=bob', 'Accept-Language': 'en, de-ch;q=0.5'},
+                                      query_string='q=x'),
+                         b'bob anon x true $(HTTP_COOKIE{name})')
+        # variables in the src of includes are replaced
+        mw = make_mw(http_content=b'<div>example</div>')
+        req = webob.Request.blank("/", query_string='id=5')
+        mw._process_include(b'<esi:include src="/item/$(QUERY_STRING{id})"/>', req)
+        self.assertEqual(mw.http.request.call_args,
+                         call('http://localhost/item/5', headers={}))
+
+    def test_invalid_utf8(self):
+        # values which are not UTF-8 are empty
+        body = (b'<esi:vars>[$(QUERY_STRING{a}|\'x\')] [$(HTTP_COOKIE{a})]</esi:vars>'
+                b'<esi:choose><esi:when test="$(QUERY_STRING{a}) == \'\'">empty</esi:when></esi:choose>')
+        self.assertEqual(self.process(body, query_string='a=%E9x', headers={'Cookie': 'a="\\351"'}),
+                         b'[x] []empty')
+        mw = make_mw(app_body=b'<esi:include src="/item/$(QUERY_STRING{a})"/>', debug=False)
+        self.assertEqual(run_mw(mw, query_string='a=%E9x'), b'')
+        self.assertEqual(mw.http.request.call_args[0][0], 'http://localhost/item/')
+
+    def test_src_quoting(self):
+        # values are percent encoded so they cannot change the URL
+        def include_url(src, query_string):
+            mw = make_mw(http_content=b'<div>example</div>')
+            req = webob.Request.blank("/", query_string=query_string)
+            mw._process_include(b'<esi:include src="' + src + b'"/>', req)
+            return mw.http.request.call_args[0][0]
+        src = b'/item/$(QUERY_STRING{id})'
+        self.assertEqual(include_url(src, 'id=%C3%A9'), 'http://localhost/item/%C3%A9')
+        self.assertEqual(include_url(src, 'id=a%20b'), 'http://localhost/item/a%20b')
+        self.assertEqual(include_url(src, 'id=x%23frag%3Fq=1'),
+                         'http://localhost/item/x%23frag%3Fq%3D1')
+        self.assertEqual(include_url(src, 'id=../admin'), 'http://localhost/item/..%2Fadmin')
+        # the whole query string is already encoded
+        self.assertEqual(include_url(b'/search?$(QUERY_STRING)', 'q=a%20b&page=2'),
+                         'http://localhost/search?q=a%20b&page=2')
+        # but not in other content
+        self.assertEqual(self.process(b'<esi:vars>$(QUERY_STRING{id})</esi:vars>', query_string='id=a%20b'),
+                         b'a b')
+
+    def test_injection(self):
+        # variables are replaced after finding the ESI markup, their values
+        # are never processed
+        mw = make_mw(http_content=b'<div>example</div>')
+        evil = quote('<esi:include src="http://169.254.169.254/latest"/>')
+        req = webob.Request.blank("/", query_string='name=' + evil)
+        self.assertEqual(mw._process_include(b'<esi:vars>Hello $(QUERY_STRING{name})</esi:vars>', req),
+                         b'Hello <esi:include src="http://169.254.169.254/latest"/>')
+        self.assertFalse(mw.http.request.called)
+        # and are encoded in the src of includes
+        for id, url in [('../admin?x=1%23', 'http://localhost/item/..%2Fadmin%3Fx%3D1%23'),
+                        ('http://evil.example.com/', 'http://localhost/item/http%3A%2F%2Fevil.example.com%2F')]:
+            req = webob.Request.blank("/", query_string='id=' + quote(id, safe='%'))
+            mw._process_include(b'<esi:vars><esi:include src="/item/$(QUERY_STRING{id})"/></esi:vars>', req)
+            self.assertEqual(mw.http.request.call_args[0][0], url)
+        # also in nested elements
+        body = (b'<esi:vars><esi:choose><esi:when test="1 == 1">$(QUERY_STRING{name}) '
+                b'<esi:include src="/item/$(QUERY_STRING{id})"/></esi:when></esi:choose></esi:vars>')
+        mw.http.request.reset_mock()
+        req = webob.Request.blank("/", query_string='name=' + evil + '&id=x')
+        self.assertEqual(mw._process_include(body, req),
+                         b'<esi:include src="http://169.254.169.254/latest"/> <div>example</div>')
+        self.assertEqual([c[0][0] for c in mw.http.request.call_args_list], ['http://localhost/item/x'])
+
+    def test_invalid(self):
+        from wesgi import InvalidESIMarkup
+        mw = make_mw()
+        req = webob.Request.blank("/")
+        unclosed = b'<esi:choose><esi:when test="1 == 1">A</esi:when>'
+        invalid_test = b'<esi:choose><esi:when test="1 == ">A</esi:when><esi:otherwise>B</esi:otherwise></esi:choose>'
+        self.assertRaises(InvalidESIMarkup, mw._process_include, unclosed, req)
+        self.assertRaises(InvalidESIMarkup, mw._process_include, invalid_test, req)
+        mw.debug = False
+        self.assertEqual(mw._process_include(unclosed, req), unclosed)
+        self.assertEqual(mw._process_include(invalid_test, req), b'B')
+
+    def test_comment(self):
+        # like includes, other ESI elements in <!--esi comments are ignored
+        body = b'<!--esi <esi:vars>$(HTTP_HOST)</esi:vars> --><esi:vars>$(HTTP_HOST)</esi:vars>'
+        mw = make_mw(app_body=body)
+        self.assertEqual(run_mw(mw), b'<!--esi <esi:vars>$(HTTP_HOST)</esi:vars> -->localhost:80')
+
+
+class TestTry(TestCase):
+
+    def make_mw(self, policy=None):
+        class Oops(Exception):
+            pass
+        def request(url, headers):
+            if 'slow' in url:
+                raise Oops(url)
+            return Response(), ('<div>%s</div>' % url).encode('ascii')
+        if policy is None:
+            mw = make_mw()
+        else:
+            mw = make_mw(policy=policy)
+        mw.http.request.side_effect = request
+        return mw
+
+    def test_try(self):
+        mw = self.make_mw()
+        req = webob.Request.blank("")
+        body = ('before<esi:try><esi:attempt>A<esi:include src="http://%s.example.com"/></esi:attempt>'
+                '<esi:except>E<esi:include src="http://except.example.com"/></esi:except></esi:try>after')
+        self.assertEqual(mw._process_include((body % 'www').encode('ascii'), req),
+                         b'beforeA<div>http://www.example.com</div>after')
+        self.assertEqual(mw._process_include((body % 'slow').encode('ascii'), req),
+                         b'beforeE<div>http://except.example.com</div>after')
+        # onerror="continue" is not a failure
+        self.assertEqual(mw._process_include(b'<esi:try><esi:attempt>A<esi:include src="http://slow.example.com" onerror="continue"/>'
+                                             b'</esi:attempt><esi:except>E</esi:except></esi:try>', req),
+                         b'A')
+        # without esi:except, nothing is included
+        self.assertEqual(mw._process_include(b'<esi:try><esi:attempt><esi:include src="http://slow.example.com"/>'
+                                             b'</esi:attempt></esi:try>', req),
+                         b'')
+
+    def test_invalid(self):
+        from wesgi import InvalidESIMarkup
+        mw = self.make_mw()
+        req = webob.Request.blank("")
+        no_attempt = b'<esi:try><esi:except>E</esi:except></esi:try>'
+        self.assertRaises(InvalidESIMarkup, mw._process_include, no_attempt, req)
+        mw.debug = False
+        self.assertEqual(mw._process_include(no_attempt, req), b'')
+
+    def test_speculative_except(self):
+        from wesgi import Policy
+        created = []
+        class SpeculativePolicy(Policy):
+            speculative_except_hosts = ('slow.example.com', )
+            def http(self):
+                http = Policy.http(self)
+                mock_http_request(http, Response(), b'<div>speculative</div>')
+                created.append(http)
+                return http
+        mw = self.make_mw(SpeculativePolicy())
+        body = ('<esi:try><esi:attempt><esi:include src="http://%s.example.com"/></esi:attempt>'
+                '<esi:except><esi:include src="http://except.example.com"/></esi:except></esi:try>')
+        req = webob.Request.blank("")
+        self.assertEqual(mw._process_include((body % 'slow').encode('ascii'), req),
+                         b'<div>speculative</div>')
+        self.assertEqual(mw.http.request.call_args_list,
+                         [call('http://slow.example.com', headers={})])
+        self.assertEqual(created[1].request.call_args_list,
+                         [call('http://except.example.com', headers={})])
+        from wesgi import _fetch_context
+        self.assertEqual(_fetch_context(req, mw).prefetched, {})
+        # the attempt does not include from a slow host
+        mw.http.request.reset_mock()
+        self.assertEqual(mw._process_include((body % 'www').encode('ascii'), req),
+                         b'<div>http://www.example.com</div>')
+        self.assertEqual(len(created), 2)
+        # hosts are compared without case and the default port
+        created[1].request.reset_mock()
+        body = ('<esi:try><esi:attempt><esi:include src="http://slow.Example.com:80/"/></esi:attempt>'
+                '<esi:except><esi:include src="http://except.example.com"/></esi:except></esi:try>')
+        self.assertEqual(mw._process_include(body.encode('ascii'), req),
+                         b'<div>speculative</div>')
+        self.assertEqual(created[1].request.call_args_list,
+                         [call('http://except.example.com', headers={})])
+
+
+class TestInline(TestCase):
+
+    def make_mw(self, body, inline_fragments=1000, responses={}, **kw):
+        from wesgi import Policy
+        policy = Policy()
+        policy.inline_fragments = inline_fragments
+        mw = make_mw(app_body=body, policy=policy, **kw)
+        mw.http.request.side_effect = lambda url, headers: (
+                Response(), responses.get(url, ('<div>%s</div>' % url).encode('ascii')))
+        return mw
+
+    def test_fetchable(self):
+        body = (b'<esi:include src="/shared"/>'
+                b'<esi:inline name="/shared" fetchable="yes"><p><esi:include src="/nested"/></p></esi:inline>'
+                b'<esi:include src="http://localhost/shared"/>')
+        mw = self.make_mw(body)
+        # the include before the esi:inline is fetched, the one after it not
+        self.assertEqual(run_mw(mw), b'<div>http://localhost/shared</div>'
+                                     b'<p><div>http://localhost/nested</div></p>'
+                                     b'<p><div>http://localhost/nested</div></p>')
+        self.assertEqual([c[0][0] for c in mw.http.request.call_args_list],
+                         ['http://localhost/shared', 'http://localhost/nested', 'http://localhost/nested'])
+        # later requests, for other pages too, are served from memory
+        mw.http.request.reset_mock()
+        mw.app = make_app(b'<esi:include src="/shared"/>')
+        self.assertEqual(run_mw(mw, environ={'PATH_INFO': '/other'}), b'<p><div>http://localhost/nested</div></p>')
+        self.assertEqual([c[0][0] for c in mw.http.request.call_args_list],
+                         ['http://localhost/nested'])
+
+    def test_not_fetchable(self):
+        body = (b'<esi:inline name="/page" fetchable="no">page</esi:inline>'
+                b'<esi:include src="/page"/>')
+        mw = self.make_mw(body)
+        self.assertEqual(run_mw(mw), b'pagepage')
+        self.assertFalse(mw.http.request.called)
+        # only for includes in the same page
+        mw.app = make_app(b'<esi:include src="/page"/>')
+        self.assertEqual(run_mw(mw), b'<div>http://localhost/page</div>')
+
+    def test_disabled(self):
+        mw = self.make_mw(b'<esi:inline name="/shared" fetchable="yes">shared</esi:inline>',
+                          inline_fragments=0)
+        self.assertEqual(run_mw(mw), b'shared')
+        mw.app = make_app(b'<esi:include src="/shared"/>')
+        self.assertEqual(run_mw(mw), b'<div>http://localhost/shared</div>')
+
+    def test_other_host(self):
+        # includes cannot replace the fragments of other hosts
+        fragment = b'<esi:inline name="http://localhost/shared" fetchable="yes">evil</esi:inline>'
+        mw = self.make_mw(b'<esi:include src="http://ads.example.com/ad"/><esi:include src="/shared"/>',
+                          responses={'http://ads.example.com/ad': fragment})
+        self.assertEqual(run_mw(mw), b'evil<div>http://localhost/shared</div>')
+        mw.app = make_app(b'<esi:include src="/shared"/>')
+        self.assertEqual(run_mw(mw), b'<div>http://localhost/shared</div>')
+
+    def test_variables(self):
+        # values of variables cannot add fragments
+        mw = self.make_mw(b'<esi:vars>Hi $(QUERY_STRING{n})</esi:vars>')
+        evil = b'<esi:inline name="/shared" fetchable="yes"><script>evil</script></esi:inline>'
+        self.assertEqual(run_mw(mw, query_string='n=' + quote(evil)), b'Hi ' + evil)
+        self.assertEqual(mw._inline_fragments.get('http://localhost/shared'), None)
+        mw.app = make_app(b'<esi:include src="/shared"/>')
+        self.assertEqual(run_mw(mw), b'<div>http://localhost/shared</div>')
+
+    def test_same_host(self):
+        fragment = b'<esi:inline name="/shared" fetchable="yes">shared</esi:inline>'
+        mw = self.make_mw(b'<esi:include src="/fragment"/><esi:include src="/shared"/>',
+                          responses={'http://localhost/fragment': fragment})
+        self.assertEqual(run_mw(mw), b'sharedshared')
+        mw.http.request.reset_mock()
+        mw.app = make_app(b'<esi:include src="/shared"/>')
+        self.assertEqual(run_mw(mw), b'shared')
+        self.assertFalse(mw.http.request.called)
+
+    def test_expires(self):
+        import wesgi
+        mw = self.make_mw(b'<esi:inline name="/shared" fetchable="yes">shared</esi:inline>')
+        self.assertEqual(run_mw(mw), b'shared')
+        mw.app = make_app(b'<esi:include src="/shared"/>')
+        now = wesgi._now() + mw.policy.inline_fragment_ttl + 1
+        with patch('wesgi._now', lambda: now):
+            self.assertEqual(run_mw(mw), b'<div>http://localhost/shared</div>')
+        self.assertEqual(mw._inline_fragments.get('http://localhost/shared'), None)
+
+    def test_invalid(self):
+        from wesgi import InvalidESIMarkup
+        mw = self.make_mw(b'')
+        req = webob.Request.blank("")
+        no_name = b'<esi:inline fetchable="yes">shared</esi:inline>'
+        self.assertRaises(InvalidESIMarkup, mw._process_include, no_name, req)
+        unclosed = b'<esi:inline name="/shared">shared'
+        self.assertRaises(InvalidESIMarkup, mw._process_include, unclosed, req)
+        mw.debug = False
+        self.assertEqual(mw._process_include(no_name, req), b'shared')
+        self.assertEqual(mw._process_include(unclosed, req), unclosed)
+
+
+class TestExpressions(TestCase):
+
+    def evaluate(self, expression, **requestkwargs):
+        from wesgi import _compile_expression, _Variables
+        variables = _Variables(webob.Request.blank("/", **requestkwargs))
+        return _compile_expression(expression)(variables)
+
+    def test_expressions(self):
+        self.assertTrue(self.evaluate(b"'a' == 'a'"))
+        self.assertFalse(self.evaluate(b"'a' != 'a'"))
+        self.assertTrue(self.evaluate(b"10 > 9"))
+        self.assertTrue(self.evaluate(b"'b' > 'a'"))
+        self.assertTrue(self.evaluate(b"'10' > '9'"))
+        self.assertTrue(self.evaluate(b"'x' > 9"))
+        self.assertTrue(self.evaluate(b"$(QUERY_STRING{a}) >= 10", query_string='a=10'))
+        self.assertFalse(self.evaluate(b"$(QUERY_STRING{a}) <= 9", query_string='a=10'))
+        self.assertTrue(self.evaluate(b"!(1 == 2) & (1 == 1 | 1 == 2)"))
+        self.assertFalse(self.evaluate(b"1 == 1 && 1 == 2"))
+        self.assertTrue(self.evaluate(b"1 == 2 || !$(HTTP_COOKIE{x})"))
+        self.assertTrue(self.evaluate(b"$(HTTP_COOKIE{x}|'y') == 'y'"))
+        self.assertTrue(self.evaluate(b"$(HTTP_ACCEPT_LANGUAGE{en})", headers={'Accept-Language': 'en-GB'}))
+        self.assertFalse(self.evaluate(b"$(HTTP_ACCEPT_LANGUAGE{en})", headers={'Accept-Language': 'de'}))
+        ua = 'Mozilla/5.0 (X11; Linux x86_64)'
+        self.assertTrue(self.evaluate(b"$(HTTP_USER_AGENT{os}) == 'UNIX' & $(HTTP_USER_AGENT{version}) == 5",
+                                      headers={'User-Agent': ua}))
+
+    def test_invalid(self):
+        from wesgi import InvalidESIMarkup, _compile_expression
+        for expression in [b"", b"1 ==", b"(1 == 1", b"1 == 1)", b"'a", b"$(HTTP_HOST", b"1 1", b"=="]:
+            self.assertRaises(InvalidESIMarkup, _compile_expression, expression)
+
+    def test_cache(self):
+        from wesgi import _compile_expression, _expressions
+        func = _compile_expression(b"1 == 3")
+        self.assertTrue(_expressions[b"1 == 3"] is func)
+        self.assertTrue(_compile_expression(b"1 == 3") is func)
+
+
 class TestMiddleWare(TestCase):
 
     def test_process(self):
@@ -338,6 +676,444 @@ class TestMiddleWare(TestCase):
                 ('http://www.example.com/relative/url', ))
 
 
+class TestCompositeETag(TestCase):
+
+    def make_mw(self, app_headers, http_headers):
+        from wesgi import Policy
+        def app(environ, start_response):
+            response = webob.Response(b'before<esi:include src="http://www.example.com"/>after',
+                                      content_type='text/html')
+            response.headers.update(app_headers)
+            return response(environ, start_response)
+        policy = Policy()
+        policy.composite_etag = True
+        mw = make_mw(app, policy=policy, http_headers=http_headers,
+                     http_content=b'<div>example</div>')
+        return mw
+
+    def run_mw(self, mw, **requestkwargs):
+        request = webob.Request.blank("", **requestkwargs)
+        return request.get_response(mw)
+
+    def test_composite_etag(self):
+        mw = self.make_mw([('ETag', '"shell"'), ('Last-Modified', 'Mon, 23 May 2016 00:00:00 GMT')],
+                          {'etag': '"fragment"'})
+        response = self.run_mw(mw)
+        self.assertEqual(response.body, b'before<div>example</div>after')
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertFalse('Last-Modified' in response.headers)
+        # the client has the page, nothing is sent
+        response = self.run_mw(mw, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        # the client has an old version
+        response = self.run_mw(mw, headers={'If-None-Match': 'W/"old"'})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.body, b'before<div>example</div>after')
+        # the etag changes with any validator
+        mw = self.make_mw([('ETag', '"shell"')], {'last-modified': 'Mon, 23 May 2016 00:00:00 GMT'})
+        self.assertNotEqual(self.run_mw(mw).headers['ETag'], etag)
+        mw = self.make_mw([('ETag', '"shell2"')], {'etag': '"fragment"'})
+        self.assertNotEqual(self.run_mw(mw).headers['ETag'], etag)
+
+    def test_no_validators(self):
+        # the validators of the page are removed if the page or any include
+        # has no validator
+        mw = self.make_mw([('ETag', '"shell"')], None)
+        response = self.run_mw(mw, headers={'If-None-Match': '"shell"'})
+        self.assertEqual(response.status_int, 200)
+        self.assertFalse('ETag' in response.headers)
+        mw = self.make_mw([('Content-Language', 'en')], {'etag': '"fragment"'})
+        response = self.run_mw(mw)
+        self.assertEqual(response.status_int, 200)
+        self.assertFalse('ETag' in response.headers)
+
+    def test_variables(self):
+        # pages using ESI variables get an ETag for the values used
+        from wesgi import Policy
+        policy = Policy()
+        policy.composite_etag = True
+        def app(environ, start_response):
+            response = webob.Response(b'<esi:vars>Hello $(HTTP_COOKIE{name})</esi:vars>'
+                                      b'<esi:choose><esi:when test="$(QUERY_STRING{x}) == 1">1</esi:when></esi:choose>',
+                                      content_type='text/html')
+            response.etag = 'shell'
+            return response(environ, start_response)
+        mw = make_mw(app, policy=policy)
+        alice = self.run_mw(mw, headers={'Cookie': 'name=alice'})
+        self.assertEqual(alice.body, b'Hello alice')
+        response = self.run_mw(mw, headers={'Cookie': 'name=alice', 'If-None-Match': alice.headers['ETag']})
+        self.assertEqual(response.status_int, 304)
+        response = self.run_mw(mw, headers={'Cookie': 'name=bob', 'If-None-Match': alice.headers['ETag']})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.body, b'Hello bob')
+        # the same for tests
+        response = self.run_mw(mw, headers={'Cookie': 'name=alice', 'If-None-Match': alice.headers['ETag']},
+                               query_string='x=1')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.body, b'Hello alice1')
+
+    def test_off_by_default(self):
+        mw = make_mw(app_body=b'before<esi:include src="http://www.example.com"/>after',
+                     http_headers={'etag': '"fragment"'})
+        request = webob.Request.blank("")
+        response = request.get_response(mw)
+        self.assertFalse('ETag' in response.headers)
+        from wesgi import _fetch_context
+        self.assertEqual(_fetch_context(request, mw).validators, None)
+
+
+class TestPrefetch(TestCase):
+
+    def test_prefetch(self):
+        import threading
+        from wesgi import Policy
+        fetched = threading.Event()
+        created = []
+        class PrefetchPolicy(Policy):
+            prefetch = 10
+            def http(self):
+                http = Policy.http(self)
+                def request(url, headers):
+                    fetched.set()
+                    return Response(), ('<div>%s</div>' % url).encode('ascii')
+                mock_http_request(http)
+                http.request.side_effect = request
+                created.append(http)
+                return http
+        body = [b'<esi:include src="/a"/><esi:include src="/b"/>']
+        app_waited = []
+        wait = [0.01]
+        def app(environ, start_response):
+            # the includes are being fetched while the page is generated
+            app_waited.append(fetched.wait(wait[0]))
+            return make_app(body[0])(environ, start_response)
+        mw = make_mw(app, policy=PrefetchPolicy(), http_content=b'<div>main</div>')
+        # the first time we can't know which includes are in the page
+        data = run_mw(mw, headers={'Host': 'www.example.com', 'Cookie': 'x'})
+        self.assertEqual(data, b'<div>main</div><div>main</div>')
+        self.assertEqual(app_waited, [False])
+        self.assertEqual(mw.http.request.call_count, 2)
+        self.assertEqual((mw.prefetch_hits, mw.prefetch_misses, mw.prefetch_wasted), (0, 2, 0))
+        # the second time they are fetched in parallel with the app
+        fetched.clear()
+        wait[0] = 1
+        mw.http.request.reset_mock()
+        body[0] = b'<esi:include src="/a"/><esi:include src="/c"/>'
+        data = run_mw(mw, headers={'Host': 'www.example.com', 'Cookie': 'x'})
+        self.assertEqual(data, b'<div>http://www.example.com/a</div><div>main</div>')
+        self.assertEqual(app_waited, [False, True])
+        self.assertEqual(mw.http.request.call_args_list,
+                         [call('http://www.example.com/c', headers={'Cookie': 'x'})])
+        prefetch_calls = []
+        for http in created[1:]:
+            prefetch_calls.extend(http.request.call_args_list)
+        self.assertEqual(sorted(prefetch_calls),
+                         [call('http://www.example.com/a', headers={'Cookie': 'x'}),
+                          call('http://www.example.com/b', headers={'Cookie': 'x'})])
+        self.assertEqual((mw.prefetch_hits, mw.prefetch_misses, mw.prefetch_wasted), (1, 3, 1))
+
+    def test_prefetch_off_by_default(self):
+        mw = make_mw(app_body=b'<esi:include src="/a"/>')
+        request = webob.Request.blank('')
+        request.get_response(mw)
+        from wesgi import _fetch_context
+        self.assertEqual(_fetch_context(request, mw).included, None)
+        self.assertEqual((mw.prefetch_hits, mw.prefetch_misses, mw.prefetch_wasted), (0, 0, 0))
+
+    def test_learn(self):
+        from wesgi import Policy
+        policy = Policy()
+        policy.prefetch = 10
+        body = (b'<esi:include src="/a"/>'
+                b'<esi:include src="/fails" alt="/alt"/>'
+                b'<esi:include src="/account/$(HTTP_COOKIE{uid})"/>'
+                b'<esi:vars><esi:include src="/vars/$(HTTP_COOKIE{uid})"/></esi:vars>'
+                b'<esi:choose><esi:when test="$(HTTP_COOKIE{uid}) == 1">'
+                b'<esi:include src="/admin-panel"/></esi:when></esi:choose>'
+                b'<esi:try><esi:attempt><esi:include src="/attempt"/></esi:attempt>'
+                b'<esi:except><esi:include src="/except"/></esi:except></esi:try>'
+                b'<esi:include src="/nested"/>'
+                b'<esi:include src="/a"/>')
+        mw = make_mw(policy=policy, app_body=body)
+        def request(url, headers):
+            if 'fails' in url:
+                return Response(status=404), b''
+            if url.endswith('/nested'):
+                return Response(), b'<esi:include src="/b"/><esi:include src="/c/$(HTTP_COOKIE{uid})"/>'
+            if url.endswith('/1'):
+                return Response(), b'<esi:include src="/d"/>'
+            return Response(), b'x'
+        mw.http.request.side_effect = request
+        run_mw(mw, headers={'Cookie': 'uid=1'})
+        # only the includes which succeeded and are the same for all users
+        self.assertEqual(mw._page_includes.get('http://localhost'),
+                         ('http://localhost/a', 'http://localhost/nested', 'http://localhost/b'))
+
+    def test_worker_pool(self):
+        import threading
+        from wesgi import _WorkerPool
+        created = []
+        def http():
+            created.append(object())
+            return created[-1]
+        pool = _WorkerPool(2, http)
+        future = pool.submit(lambda http, a, b: (http, a + b), 1, 2)
+        self.assertEqual(future.result(), (created[0], 3))
+        class Oops(Exception):
+            pass
+        def oops(http):
+            raise Oops()
+        self.assertRaises(Oops, pool.submit(oops).result)
+        # the thread is reused
+        self.assertEqual(len(created), 1)
+        # nothing is started while all threads are busy
+        release = threading.Event()
+        busy = [pool.submit(lambda http: release.wait(5)) for i in range(2)]
+        self.assertEqual(pool.submit(lambda http: None), None)
+        release.set()
+        self.assertEqual([f.result() for f in busy], [True, True])
+        self.assertEqual(pool.submit(lambda http: 1).result(), 1)
+        self.assertEqual(len(created), 2)
+
+    def test_prefetch_saturated(self):
+        from wesgi import Policy, _WorkerPool
+        policy = Policy()
+        policy.prefetch = 10
+        mw = make_mw(policy=policy, app_body=b'<esi:include src="/a"/>')
+        mw._page_includes.set('http://localhost', ('http://localhost/a', ))
+        mw._workers = _WorkerPool(0, None)
+        self.assertEqual(run_mw(mw), b'')
+        # fetched when needed instead
+        self.assertEqual(mw.http.request.call_count, 1)
+        self.assertEqual((mw.prefetch_hits, mw.prefetch_misses, mw.prefetch_wasted), (0, 1, 0))
+
+
+class TestTrace(TestCase):
+
+    def make_mw(self, policy=None, app_body=None, **kw):
+        class Oops(Exception):
+            pass
+        def request(url, headers):
+            if 'broken' in url:
+                raise Oops(url)
+            if url.endswith('/nested'):
+                return Response(), b'<esi:include src="/leaf"/>'
+            return Response(), b'<div>leaf</div>'
+        if app_body is None:
+            app_body = (b'<esi:include src="/nested"/>'
+                        b'<esi:include src="/broken" alt="/alt"/>'
+                        b'<esi:include src="/broken" onerror="continue"/>')
+        mw = make_mw(policy=policy or 'default', app_body=app_body, **kw)
+        mw.http.request.side_effect = request
+        return mw
+
+    def strip_times(self, node, root=True):
+        self.assertTrue(node.pop('start') <= node.pop('end'))
+        if root:
+            self.assertTrue(node.pop('app') >= 0)
+        for child in node.get('includes', ()):
+            self.strip_times(child, root=False)
+        return node
+
+    def test_header(self):
+        import json
+        mw = self.make_mw()
+        request = webob.Request.blank("/page", headers={'X-ESI-Trace': '1'})
+        response = request.get_response(mw)
+        self.assertEqual(response.body, b'<div>leaf</div><div>leaf</div>')
+        trace = self.strip_times(json.loads(response.headers['X-ESI-Trace']))
+        self.assertEqual(trace, {
+            'url': 'http://localhost/page', 'status': 200, 'bytes': 30,
+            'includes': [
+                {'url': 'http://localhost/nested', 'status': 200, 'bytes': 26, 'cache': 'miss',
+                 'includes': [{'url': 'http://localhost/leaf', 'status': 200, 'bytes': 15, 'cache': 'miss'}]},
+                {'url': 'http://localhost/alt', 'status': 200, 'bytes': 15, 'cache': 'miss',
+                 'error': 'Oops', 'fallback': 'alt'},
+                {'error': 'Oops', 'fallback': 'continue'}]})
+        # only if requested
+        response = webob.Request.blank("/page").get_response(mw)
+        self.assertFalse('X-ESI-Trace' in response.headers)
+        # and in debug mode
+        mw = self.make_mw(debug=False)
+        response = webob.Request.blank("/page", headers={'X-ESI-Trace': '1'}).get_response(mw)
+        self.assertFalse('X-ESI-Trace' in response.headers)
+
+    def test_comment_and_callback(self):
+        import json
+        from wesgi import Policy
+        policy = Policy()
+        policy.trace = True
+        policy.trace_output = 'comment'
+        mw = self.make_mw(policy, debug=False)
+        body = webob.Request.blank("/page--x").get_response(mw).body
+        self.assertTrue(body.startswith(b'<div>leaf</div><div>leaf</div><!-- esi trace: {'), body)
+        self.assertTrue(body.endswith(b'} -->'), body)
+        comment = body[len(b'<div>leaf</div><div>leaf</div><!-- esi trace: '):-len(b' -->')]
+        self.assertFalse(b'--' in comment)
+        self.assertEqual(json.loads(comment.decode('ascii'))['url'], 'http://localhost/page--x')
+        traces = []
+        policy.trace_output = lambda trace, req: traces.append((trace, req))
+        mw = self.make_mw(policy, debug=False)
+        request = webob.Request.blank("/page")
+        body = request.get_response(mw).body
+        self.assertEqual(body, b'<div>leaf</div><div>leaf</div>')
+        self.assertEqual(len(traces), 1)
+        self.assertEqual(len(traces[0][0]['includes']), 3)
+        self.assertEqual(traces[0][1].environ, request.environ)
+
+    def test_except(self):
+        import json
+        try_ = (b'<esi:try><esi:attempt><esi:include src="/%s"/></esi:attempt>'
+                b'<esi:except><esi:include src="/leaf"/></esi:except></esi:try>')
+        mw = self.make_mw(app_body=try_.replace(b'%s', b'broken') + try_.replace(b'%s', b'leaf'))
+        response = webob.Request.blank("/page", headers={'X-ESI-Trace': '1'}).get_response(mw)
+        self.assertEqual(response.body, b'<div>leaf</div><div>leaf</div>')
+        trace = self.strip_times(json.loads(response.headers['X-ESI-Trace']))
+        # each esi:try has a node with its fallback
+        self.assertFalse('fallback' in trace)
+        broken, ok = trace['includes']
+        self.assertEqual(broken['block'], 'try')
+        self.assertEqual(broken['fallback'], 'except')
+        self.assertEqual(broken['includes'][0], {'error': 'Oops'})
+        self.assertEqual(broken['includes'][1]['url'], 'http://localhost/leaf')
+        self.assertEqual(ok['block'], 'try')
+        self.assertFalse('fallback' in ok)
+        self.assertEqual([node['url'] for node in ok['includes']], ['http://localhost/leaf'])
+
+    def test_streamed(self):
+        import json
+        from wesgi import Policy
+        policy = Policy()
+        policy.trace = True
+        read = []
+        def body():
+            read.append(True)
+            yield b'data'
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+            return body()
+        mw = make_mw(app, policy=policy)
+        response = webob.Request.blank("/file").get_response(mw)
+        trace = json.loads(response.headers['X-ESI-Trace'])
+        self.assertFalse('bytes' in trace)
+        # the body is not read to trace it
+        self.assertEqual(read, [])
+        self.assertEqual(b''.join(response.app_iter), b'data')
+
+
+class TestFetchContext(TestCase):
+
+    def test_headers(self):
+        from wesgi import _FetchContext
+        req = webob.Request.blank("/page", headers={'Host': 'www.example.com',
+                                                    'Cookie': 'x',
+                                                    'Accept-Language': 'en',
+                                                    'Content-Length': '10'})
+        context = _FetchContext(req)
+        self.assertEqual(context.same_origin_headers, {'Cookie': 'x', 'Accept-Language': 'en'})
+        self.assertEqual(context.all_servers_headers, {'Accept-Language': 'en'})
+        def headers(url):
+            return context.headers(url, urlsplit(url))
+        self.assertTrue(headers('http://www.example.com/a') is context.same_origin_headers)
+        self.assertTrue(headers('http://www.example.com:80/b') is context.same_origin_headers)
+        self.assertTrue(headers('https://www.example.com/a') is context.all_servers_headers)
+        self.assertTrue(headers('http://www.example.net/a') is context.all_servers_headers)
+
+    def test_vary(self):
+        from wesgi import Policy
+        policy = Policy()
+        policy.vary_cookies = ('theme', 'lang')
+        policy.vary_languages = ('en-US', 'de')
+        mw = make_mw(policy=policy, http_headers={'vary': 'Cookie, Accept-Language'})
+        req_headers = {'Host': 'www.example.com',
+                       'Cookie': 'session=secret; lang=de; theme=dark',
+                       'Accept-Language': 'fr, de-CH;q=0.8, en;q=0.5',
+                       'Referer': 'http://www.example.com/'}
+        def forwarded(headers):
+            return dict((k, v) for k, v in headers.items() if k != 'Host')
+        include = b'<esi:include src="http://www.example.com/vary"/>'
+        # the first time we don't know the response varies
+        mw._process_include(include, webob.Request.blank('/', headers=req_headers))
+        self.assertEqual(mw.http.request.call_args,
+                         call('http://www.example.com/vary', headers=forwarded(req_headers)))
+        mw._process_include(include, webob.Request.blank('/', headers=req_headers))
+        self.assertEqual(mw.http.request.call_args,
+                         call('http://www.example.com/vary', headers={
+                             'Cookie': 'lang=de; theme=dark',
+                             'Accept-Language': 'de',
+                             'Referer': 'http://www.example.com/'}))
+        # headers are removed if nothing is left
+        req_headers['Cookie'] = 'session=secret'
+        req_headers['Accept-Language'] = 'fr'
+        mw._process_include(include, webob.Request.blank('/', headers=req_headers))
+        self.assertEqual(mw.http.request.call_args,
+                         call('http://www.example.com/vary', headers={
+                             'Referer': 'http://www.example.com/'}))
+        # without policy, the headers are not changed
+        mw = make_mw(http_headers={'vary': 'Cookie, Accept-Language'})
+        mw._process_include(include, webob.Request.blank('/', headers=req_headers))
+        mw._process_include(include, webob.Request.blank('/', headers=req_headers))
+        self.assertEqual(mw.http.request.call_args,
+                         call('http://www.example.com/vary', headers=forwarded(req_headers)))
+        # when the response no longer varies, neither do we
+        mw = make_mw(policy=policy)
+        mw._process_include(include, webob.Request.blank('/', headers=req_headers))
+        mw._process_include(include, webob.Request.blank('/', headers=req_headers))
+        self.assertEqual(mw.http.request.call_args,
+                         call('http://www.example.com/vary', headers=forwarded(req_headers)))
+
+    def test_normalize_accept_language(self):
+        from wesgi import _normalize_accept_language
+        self.assertEqual(_normalize_accept_language('en-US,en;q=0.9, DE;q=0.95,fr;q=0', True),
+                         'en-us,de,en')
+        self.assertEqual(_normalize_accept_language('fr;q=0.1, *;q=0.05', ('en', 'de')), 'en')
+        self.assertEqual(_normalize_accept_language('en-GB, en;q=0.9', ('de', 'en-US')), 'en-US')
+        self.assertEqual(_normalize_accept_language('en-GB', ('de', 'en-US')), '')
+
+    def test_resolve(self):
+        from wesgi import _resolve, _resolved_urls
+        url, split = _resolve('http://www.example.com/page/', b'../a')
+        self.assertEqual(url, 'http://www.example.com/a')
+        self.assertEqual(split.netloc, 'www.example.com')
+        self.assertTrue(_resolve('http://www.example.com/page/', b'../a')[1] is split)
+        self.assertEqual(_resolved_urls[('http://www.example.com/page/', b'../a')], (url, split))
+        # absolute urls and urls starting with / are shared by all pages
+        self.assertEqual(_resolve('http://www.example.com/page/1', b'http://other.example.com/a')[0],
+                         'http://other.example.com/a')
+        self.assertTrue((None, b'http://other.example.com/a') in _resolved_urls)
+        self.assertEqual(_resolve('https://www.example.com/page/1?x=1', b'/a')[0],
+                         'https://www.example.com/a')
+        self.assertTrue(_resolve('https://www.example.com/page/2', b'/a') is
+                        _resolved_urls[('https://www.example.com', b'/a')])
+        self.assertEqual(_resolve('https://www.example.com', b'/a')[0], 'https://www.example.com/a')
+        self.assertEqual(_resolve('https://www.example.com/page/2', b'//cdn.example.com/a')[0],
+                         'https://cdn.example.com/a')
+
+    def test_stacked_middleware(self):
+        # a middleware wrapping another does not share it's context
+        from wesgi import Policy
+        policy = Policy()
+        policy.trace = True
+        inner = make_mw(app_body=b'<esi:include src="/a"/>', policy=policy, http_content=b'a')
+        outer = make_mw(inner)
+        response = webob.Request.blank('').get_response(outer)
+        self.assertEqual(response.body, b'a')
+        self.assertTrue('X-ESI-Trace' in response.headers)
+        self.assertFalse(outer.http.request.called)
+
+    def test_memo(self):
+        from wesgi import _Memo
+        memo = _Memo(2)
+        memo[1] = 1
+        memo[2] = 2
+        self.assertEqual(memo, {1: 1, 2: 2})
+        memo[3] = 3
+        self.assertEqual(memo, {3: 3})
+
+
 class TestPolicy(TestCase):
 
     def test_chase_redirect(self):
@@ -355,6 +1131,381 @@ class TestPolicy(TestCase):
         policy = Policy()
         self.assertEqual(policy.cache, None)
 
+class TestHostLimiter(TestCase):
+
+    def test_limits(self):
+        from wesgi import _HostLimiter, IncludeError
+        limiter = _HostLimiter(2, timeout=0.01)
+        self.assertTrue(limiter.acquire('www.example.com'))
+        self.assertTrue(limiter.acquire('www.example.com'))
+        self.assertTrue(limiter.acquire('www.example.net'))
+        self.assertRaises(IncludeError, limiter.acquire, 'www.example.com')
+        self.assertEqual(limiter.timeouts, 1)
+        limiter.release('www.example.com')
+        self.assertTrue(limiter.acquire('www.example.com'))
+        # limits per host, other hosts are not limited
+        limiter = _HostLimiter({'www.example.com': 1}, timeout=0.01)
+        self.assertTrue(limiter.acquire('www.example.com'))
+        self.assertRaises(IncludeError, limiter.acquire, 'www.example.com')
+        self.assertFalse(limiter.acquire('www.example.net'))
+        # without case and the default port
+        limiter = _HostLimiter({'RECS.example.com:80': 1}, timeout=0.01)
+        self.assertTrue(limiter.acquire('recs.example.com'))
+        self.assertRaises(IncludeError, limiter.acquire, 'Recs.Example.com:80')
+        limiter.release('RECS.example.com')
+        self.assertTrue(limiter.acquire('recs.example.com:80'))
+
+    def test_include_hosts(self):
+        from wesgi import Policy
+        policy = Policy()
+        policy.max_connections_per_host = {'recs.example.com': 1}
+        mw = make_mw(policy=policy, http_content=b'x')
+        hosts = []
+        acquire = mw.limiter.acquire
+        def record(host):
+            hosts.append(host)
+            return acquire(host)
+        mw.limiter.acquire = record
+        req = webob.Request.blank("/")
+        mw._process_include(b'<esi:include src="http://RECS.example.com/a"/>'
+                            b'<esi:include src="http://recs.example.com:80/b"/>'
+                            b'<esi:include src="https://recs.example.com:443/c"/>', req)
+        self.assertEqual(hosts, ['recs.example.com'] * 3)
+
+    def test_waits_for_release(self):
+        from wesgi import _HostLimiter
+        import threading
+        limiter = _HostLimiter(1)
+        limiter.acquire('www.example.com')
+        acquired = []
+        def wait():
+            acquired.append(limiter.acquire('www.example.com'))
+        t = threading.Thread(target=wait)
+        t.start()
+        t.join(0.05)
+        self.assertEqual(acquired, [])
+        limiter.release('www.example.com')
+        t.join()
+        self.assertEqual(acquired, [True])
+
+    def test_middleware(self):
+        # when the limit is reached, the include fails and alt is used
+        from wesgi import Policy
+        policy = Policy()
+        policy.max_connections_per_host = {'www.example.com': 1}
+        policy.connection_wait_timeout = 0.01
+        mw = make_mw(policy=policy, http_content=b'<div>example</div>')
+        req = webob.Request.blank("")
+        data = mw._process_include(b'<esi:include src="http://www.example.com" alt="http://alt.example.com"/>', req)
+        self.assertEqual(data, b'<div>example</div>')
+        self.assertEqual(mw.http.request.call_args_list,
+                         [call('http://www.example.com', headers={})])
+        mw.limiter.acquire('www.example.com')
+        data = mw._process_include(b'<esi:include src="http://www.example.com" alt="http://alt.example.com"/>', req)
+        self.assertEqual(mw.http.request.call_args_list,
+                         [call('http://www.example.com', headers={}),
+                          call('http://alt.example.com', headers={})])
+        self.assertEqual(mw.limiter.timeouts, 1)
+        # no limiter by default
+        self.assertEqual(Policy().limiter(), None)
+
+def serve_http(server_class, address):
+    """
+    Serve a page containing the Host header and path in a thread.
+
+    ``/size/N`` serves N bytes, without Content-Length if the query is
+    ``close``, gzipped if it is ``gzip`` and the client accepts it or
+    ``always``.
+    """
+    import sys
+    import socket
+    import threading
+    try:
+        from http.server import BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        # Python 2
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        from SocketServer import ThreadingMixIn
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            if path.startswith('/size/'):
+                body = b'x' * int(path[len('/size/'):])
+            else:
+                body = ('%s %s' % (self.headers['Host'], self.path)).encode('ascii')
+            gzipped = query == 'always' or (
+                query == 'gzip' and 'gzip' in self.headers.get('Accept-Encoding', ''))
+            if gzipped:
+                import zlib
+                compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                body = compressor.compress(body) + compressor.flush()
+            self.send_response(200)
+            if gzipped:
+                self.send_header('Content-Encoding', 'gzip')
+            if query == 'close':
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            else:
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    def handle_error(self, request, client_address):
+        # clients closing connections with unread data reset them
+        if not isinstance(sys.exc_info()[1], socket.error):
+            server_class.handle_error(self, request, client_address)
+    # connections are kept alive, so handle each in a thread of its own
+    server_class = type('Server', (ThreadingMixIn, server_class),
+                        {'daemon_threads': True, 'handle_error': handle_error})
+    server = server_class(address, Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class TestHostMap(TestCase):
+
+    def test_tcp(self):
+        from wesgi import Policy
+        try:
+            from socketserver import TCPServer
+        except ImportError:
+            # Python 2
+            from SocketServer import TCPServer
+        server = serve_http(TCPServer, ('127.0.0.1', 0))
+        try:
+            policy = Policy()
+            policy.host_map = {'fragments.example.com': '127.0.0.1:%s' % server.server_address[1]}
+            http = policy.http()
+            for i in range(2):
+                resp, content = http.request('http://fragments.example.com/a?b=%s' % i)
+                self.assertEqual(resp.status, 200)
+                self.assertEqual(content, ('fragments.example.com /a?b=%s' % i).encode('ascii'))
+            # the connection is reused
+            self.assertEqual(list(http.connections), ['http:fragments.example.com'])
+            # the default port is the same host
+            resp, content = http.request('http://Fragments.example.com:80/c')
+            self.assertEqual(content, b'fragments.example.com /c')
+            for conn in http.connections.values():
+                conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_ipv6(self):
+        import socket
+        from wesgi import Policy
+        try:
+            from socketserver import TCPServer
+        except ImportError:
+            # Python 2
+            from SocketServer import TCPServer
+        class TCP6Server(TCPServer):
+            address_family = socket.AF_INET6
+        try:
+            server = serve_http(TCP6Server, ('::1', 0))
+        except socket.error:
+            # no IPv6
+            return
+        try:
+            policy = Policy()
+            policy.host_map = {'fragments.example.com': '[::1]:%s' % server.server_address[1]}
+            http = policy.http()
+            resp, content = http.request('http://fragments.example.com/a')
+            self.assertEqual(content, b'fragments.example.com /a')
+            for conn in http.connections.values():
+                conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_unix_socket(self):
+        import shutil
+        import tempfile
+        from wesgi import Policy
+        try:
+            from socketserver import UnixStreamServer
+        except ImportError:
+            # Python 2
+            from SocketServer import UnixStreamServer
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'fragments.sock')
+            server = serve_http(UnixStreamServer, path)
+            policy = Policy()
+            policy.host_map = {'fragments.example.com:8080': 'unix:' + path}
+            mw = make_mw(policy=policy,
+                         app_body=b'<esi:include src="http://fragments.example.com:8080/a"/>')
+            mw.http = policy.http()
+            self.assertEqual(run_mw(mw), b'fragments.example.com:8080 /a')
+            for conn in mw.http.connections.values():
+                conn.close()
+            server.shutdown()
+            server.server_close()
+        finally:
+            shutil.rmtree(tmpdir)
+        # only the mapped hosts get another connection type
+        self.assertEqual(list(policy.http().connection_types), ['fragments.example.com:8080'])
+        self.assertFalse(hasattr(Policy().http(), 'connection_types'))
+
+
+class TestMaxFragmentSize(TestCase):
+
+    def setUp(self):
+        try:
+            from socketserver import TCPServer
+        except ImportError:
+            # Python 2
+            from SocketServer import TCPServer
+        self.server = serve_http(TCPServer, ('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_http(self):
+        from wesgi import Policy, IncludeError
+        policy = Policy()
+        policy.max_fragment_size = 100000
+        http = policy.http()
+        resp, content = http.request(self.url + '/size/100000')
+        self.assertEqual(len(content), 100000)
+        # too large according to Content-Length
+        self.assertRaises(IncludeError, http.request, self.url + '/size/100001')
+        # the connection was closed, a new one is opened
+        conn, = http.connections.values()
+        self.assertEqual(conn.sock, None)
+        resp, content = http.request(self.url + '/size/10')
+        self.assertEqual(content, b'x' * 10)
+        # too large while reading
+        self.assertRaises(IncludeError, http.request, self.url + '/size/1000000?close')
+        resp, content = http.request(self.url + '/size/100000?close')
+        self.assertEqual(len(content), 100000)
+        # compressed includes are limited by their uncompressed size
+        self.assertRaises(IncludeError, http.request, self.url + '/size/1000000?gzip')
+        resp, content = http.request(self.url + '/size/100000?gzip')
+        self.assertEqual(len(content), 100000)
+        self.assertFalse('-content-encoding' in resp)
+        if hasattr(http, 'limit_kwargs'):
+            # even if the server compresses them anyway
+            self.assertRaises(Exception, http.request, self.url + '/size/1000000?always')
+        resp, content = http.request(self.url + '/size/100000?always')
+        self.assertEqual(len(content), 100000)
+        conn.close()
+        # no limit by default
+        http = Policy().http()
+        resp, content = http.request(self.url + '/size/1000000?close')
+        self.assertEqual(len(content), 1000000)
+        http.connections.popitem()[1].close()
+
+    def test_middleware(self):
+        from wesgi import Policy
+        policy = Policy()
+        policy.max_fragment_size = 100
+        app_body = ('<esi:include src="%s/size/101" alt="%s/size/3"/>'
+                    '<esi:include src="%s/size/101?close" onerror="continue"/>'
+                    '<esi:include src="%s/size/100"/>' % ((self.url, ) * 4)).encode('ascii')
+        mw = make_mw(policy=policy, app_body=app_body)
+        mw.http = policy.http()
+        self.assertEqual(run_mw(mw), b'x' * 103)
+        for conn in mw.http.connections.values():
+            conn.close()
+        # mocked, cached or decompressed includes are also limited
+        mw = make_mw(policy=policy, app_body=b'<esi:include src="/a" onerror="continue"/>')
+        mock_http_request(mw.http, content=b'x' * 101)
+        self.assertEqual(run_mw(mw), b'')
+
+
+class TestReplay(TestCase):
+
+    def record(self):
+        from io import StringIO
+        from wesgi import Policy
+        from wesgi.replay import Recorder, load
+        contents = {'http://localhost/a': b'<esi:include src="/b"/>' + b'a' * 100,
+                    'http://localhost/b': b'b' * 1000,
+                    'http://localhost/c': b'c' * 10}
+        def request(url, headers):
+            return Response(), contents[url]
+        output = StringIO()
+        policy = Policy()
+        policy.trace = True
+        policy.trace_output = Recorder(output)
+        mw = make_mw(policy=policy, app_body=b'<esi:include src="/a"/><esi:include src="/c"/>')
+        mw.http.request.side_effect = request
+        self.assertEqual(run_mw(mw, headers={'Cookie': 'session=secret', 'Accept-Language': 'en'}),
+                         b'b' * 1000 + b'a' * 100 + b'c' * 10)
+        output.seek(0)
+        return load(output)
+
+    def test_record(self):
+        record, = self.record()
+        self.assertEqual(record['url'], 'http://localhost')
+        self.assertEqual(record['headers']['Cookie'], 'redacted')
+        self.assertEqual(record['headers']['Accept-Language'], 'en')
+        a, c = record['trace']['includes']
+        self.assertEqual((a['url'], a['bytes'], a['status']), ('http://localhost/a', 123, 200))
+        self.assertEqual(a['includes'][0]['url'], 'http://localhost/b')
+        self.assertEqual(c['url'], 'http://localhost/c')
+
+    def test_replay(self):
+        from wesgi import Policy, LRUCache
+        from wesgi.replay import replay, format_report
+        records = self.record()
+        policy = Policy()
+        policy.cache = LRUCache()
+        report = replay(records, policy, concurrency=1, requests=5, max_age=60, seed=0)
+        self.assertEqual(report['requests'], 5)
+        self.assertEqual(report['errors'], 0)
+        # the includes were fetched once, then cached
+        self.assertEqual(report['origin_requests'], 3)
+        self.assertEqual(report['cache_hit_ratio'], 0.8)
+        self.assertTrue(report['p50_ms'] <= report['p99_ms'] <= report['max_ms'])
+        self.assertTrue('requests_per_second:' in format_report(report))
+        # the policy is not changed
+        self.assertEqual(policy.host_map, None)
+        # without caching, every request fetches the includes
+        report = replay(records, concurrency=2, requests=4)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['origin_requests'], 12)
+        self.assertEqual(report['cache_hit_ratio'], None)
+
+    def test_try(self):
+        from wesgi.replay import _Origin
+        trace = {'bytes': 60, 'includes': [
+                    {'block': 'try', 'start': 0, 'end': 5, 'includes': [
+                        {'url': 'http://localhost/a', 'bytes': 10, 'status': 200, 'cache': 'miss',
+                         'start': 0, 'end': 5}]}]}
+        origin = _Origin([{'url': 'http://localhost/', 'headers': {}, 'trace': trace}])
+        body = origin.pages['http://localhost/'].body
+        self.assertTrue(body.startswith(b'<esi:include src="http://localhost/a"/>x'))
+        self.assertEqual(len(body), 50)
+        self.assertEqual(list(origin.includes), ['http://localhost/a'])
+        self.assertEqual(origin.includes['http://localhost/a'].latencies, [5])
+
+    def test_main(self):
+        import json
+        import tempfile
+        from wesgi.replay import main
+        records = self.record()
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(''.join([json.dumps(record) + '\n' for record in records]))
+        with patch('sys.stdout') as stdout:
+            main([path, '--requests', '3', '--max-age', '60', '--cache-size', '10'])
+        output = ''.join([c[0][0] for c in stdout.write.call_args_list])
+        self.assertTrue('requests:            3' in output, output)
+        self.assertTrue('cache_hit_ratio:     0.667' in output, output)
+        with patch('sys.stderr'):
+            self.assertRaises(SystemExit, main, [])
+
+
 class TestLRUCache(TestCase):
 
     def test_basic(self):
@@ -405,6 +1556,71 @@ class TestLRUCache(TestCase):
         cache.set('a', 'a')
         self.assertEqual(cache._cache, {'a': 'a'})
 
+    def test_compression(self):
+        from wesgi import LRUCache
+        cache = LRUCache(maxsize=3, compress_threshold=100)
+        big = b'<div>fragment</div>' * 100
+        # small values are stored as is
+        cache.set('a', b'<div/>')
+        self.assertEqual(cache._cache['a'], b'<div/>')
+        # large values are compressed and transparently decompressed
+        cache.set('b', big)
+        self.assertTrue(len(cache._cache['b']) < len(big))
+        self.assertEqual(cache.get('b'), big)
+        self.assertEqual(cache.compressed, 1)
+        self.assertEqual(cache.bytes_saved, len(big) - len(cache._cache['b']))
+        self.assertTrue(cache.compress_time > 0)
+        # non bytes values are never compressed
+        cache.set('c', 'x' * 1000)
+        self.assertEqual(cache._cache['c'], 'x' * 1000)
+        self.assertEqual(cache.compressed, 1)
+        self.assertInvariants(cache)
+
+    def test_compression_max_object_size(self):
+        # max_object_size applies to the compressed size
+        from wesgi import LRUCache
+        cache = LRUCache(maxsize=3, max_object_size=1000, compress_threshold=100)
+        cache.set('a', b'a' * 2000)
+        self.assertEqual(cache.get('a'), b'a' * 2000)
+        # incompressible values are stored uncompressed (and here, ignored)
+        import os
+        cache.set('b', os.urandom(2000))
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.compressed, 1)
+
+    def test_purge_tag(self):
+        from wesgi import LRUCache
+        cache = LRUCache(maxsize=3, compress_threshold=10)
+        def value(surrogate_key):
+            return (b'status: 200\r\ncontent-type: text/html\r\n'
+                    b'surrogate-key: ' + surrogate_key + b'\r\n\r\n'
+                    b'<div>surrogate-key: not a header</div>')
+        cache.set('a', value(b'header nav'))
+        cache.set('b', value(b'nav  footer'))
+        cache.set('c', b'status: 200\r\n\r\nsurrogate-key: nav\r\n')
+        self.assertEqual(cache._tags, {'header': {'a': True},
+                                       'nav': {'a': True, 'b': True},
+                                       'footer': {'b': True}})
+        self.assertEqual(cache.purge_tag('nav'), 2)
+        self.assertEqual(sorted(cache._cache), ['c'])
+        self.assertEqual(cache._tags, {})
+        self.assertEqual(cache._key_tags, {})
+        self.assertEqual(cache.purge_tag('nav'), 0)
+        # replacing or deleting an object updates the tags
+        cache.set('a', value(b'header'))
+        cache.set('a', value(b'footer'))
+        self.assertEqual(cache._tags, {'footer': {'a': True}})
+        cache.delete('a')
+        self.assertEqual(cache._tags, {})
+        self.assertInvariants(cache)
+        # as does eviction
+        cache = LRUCache(maxsize=1)
+        cache.set('a', value(b'header'))
+        cache.set('b', 'b')
+        self.assertEqual(cache._cache, {'b': 'b'})
+        self.assertEqual(cache._tags, {})
+        self.assertInvariants(cache)
+
     def test_hit_miss(self):
         # an LRU's biggest weakness is the sequential scan
         # this is what happens
@@ -442,6 +1658,46 @@ class TestLRUCache(TestCase):
         self.assertEqual(cache.misses, 102)
         self.assertInvariants(cache)
 
+    def test_tinylfu_resists_scans(self):
+        # with tinylfu admission, a scan of one-off keys does not evict
+        # the popular ones
+        from wesgi import LRUCache
+        def traffic(cache):
+            for i in range(500):
+                if not i % 20:
+                    # popular keys, accessed less often than the cache size
+                    for k in 'abc':
+                        if cache.get(k) is None:
+                            cache.set(k, k)
+                # a crawler
+                cache.get(i)
+                cache.set(i, i)
+        cache = LRUCache(maxsize=10)
+        traffic(cache)
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(cache.rejected, 0)
+        cache = LRUCache(maxsize=10, tinylfu=True)
+        traffic(cache)
+        self.assertTrue(cache.hits > 60, cache.hits)
+        self.assertTrue(cache.rejected > 400, cache.rejected)
+        self.assertEqual(len(cache._cache), 10)
+        for k in 'abc':
+            self.assertEqual(cache._cache[k], k)
+        self.assertInvariants(cache)
+
+    def test_count_min_sketch(self):
+        from wesgi import _CountMinSketch
+        sketch = _CountMinSketch(16)
+        self.assertEqual(sketch.estimate('a'), 0)
+        for i in range(20):
+            sketch.increment('a')
+        sketch.increment('b')
+        # counters saturate at 15
+        self.assertEqual(sketch.estimate('a'), 15)
+        self.assertTrue(sketch.estimate('b') >= 1)
+        sketch.age()
+        self.assertEqual(sketch.estimate('a'), 7)
+
     def test_repeated_set_without_get_does_not_flushe_cache(self):
         from wesgi import LRUCache
         cache = LRUCache(maxsize=3)